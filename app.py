@@ -1,18 +1,34 @@
 import os
-import json
+import threading
 from urllib.parse import quote_plus, urlencode
 
-from flask import Flask,request, abort, make_response, jsonify, render_template, flash, redirect, session, url_for
+from flask import Flask,request, abort, make_response, render_template, flash, redirect, session, url_for, stream_with_context
 from models import *
 from flask_cors import CORS
 from sqlalchemy import insert
 from forms import *
 from user import auth0_create_user
+import user
 from auth import AuthError, requires_auth
-from authlib.integrations.flask_client import OAuth
 from flask_wtf.csrf import CSRFProtect
-from config import setup_db, db
+from config import setup_db, db, database_path
 from pagination import *
+from counters import row_count
+import counters
+import cache
+import catalog
+import versions
+import ratings
+import search
+from search import search_items
+import bulk
+import export
+import jobs
+import instrumentation
+import metrics
+import transaction
+import fastjson
+from fastjson import jsonify
 
 
 
@@ -21,20 +37,21 @@ def create_app(test_config=None):
     csrf = CSRFProtect(app)
     csrf.init_app(app)
     app.config.from_object('config')
-
-    oauth = OAuth(app)
-
-    oauth.register(
-        "auth0",
-        client_id=os.getenv("AUTH0_CLIENT_ID"),
-        client_secret=os.getenv("AUTH0_CLIENT_SECRET"),
-        client_kwargs={
-            "scope": "openid profile email",
-        },
-        server_metadata_url=f'https://{os.getenv("AUTH0_DOMAIN")}/.well-known/openid-configuration'
-    )
-
-    setup_db(app)
+    if test_config is not None:
+        app.config.update(test_config)
+
+    setup_db(app, app.config.get('SQLALCHEMY_DATABASE_URI', database_path))
+    metrics.init_app(app)
+    instrumentation.init_app(app)
+    transaction.init_app(app)
+    fastjson.init_app(app)
+    counters.init_app(app)
+    cache.init_app(app)
+    versions.init_app(app)
+    search.init_app(app)
+    ratings.init_app(app)
+    jobs.init_app(app)
+    user.init_app(app)
     #CORS(app)
 
     @app.after_request
@@ -52,15 +69,40 @@ def create_app(test_config=None):
         return render_template('pages/home.html')
 
 
+    oauth_client = {}
+    oauth_lock = threading.Lock()
+
+    def auth0_client():
+        '''
+        the Auth0 OAuth client, built on the first /login: authlib is only
+        imported then and the OpenID metadata fetched on its first use
+        '''
+        with oauth_lock:
+            if 'auth0' not in oauth_client:
+                from authlib.integrations.flask_client import OAuth
+
+                oauth = OAuth(app)
+                oauth.register(
+                    "auth0",
+                    client_id=os.getenv("AUTH0_CLIENT_ID"),
+                    client_secret=os.getenv("AUTH0_CLIENT_SECRET"),
+                    client_kwargs={
+                        "scope": "openid profile email",
+                    },
+                    server_metadata_url=f'https://{os.getenv("AUTH0_DOMAIN")}/.well-known/openid-configuration'
+                )
+                oauth_client['auth0'] = oauth.auth0
+            return oauth_client['auth0']
+
     @app.route("/login")
     def login():
-        return oauth.auth0.authorize_redirect(
+        return auth0_client().authorize_redirect(
             redirect_uri=url_for("callback", _external=True)
         )
 
     @app.route("/login-results", methods=["GET", "POST"])
     def callback():
-        token = oauth.auth0.authorize_access_token()
+        token = auth0_client().authorize_access_token()
         session["user"] = token
         session["username"] = "Username:TODO"
         return redirect("/")
@@ -95,25 +137,28 @@ def create_app(test_config=None):
 
         try:
             form = UserForm(request.form, meta={"csrf": False})
-            print('form ', form)
             if form.validate():
                 email = request.form['email']
                 password = request.form['password']
 
-                res = auth0_create_user(email, password)
-
-                #print(res)
-                #print(res.get("auth_user_id"))
+                job = jobs.signup_jobs.submit("signup", auth0_create_user, email, password)
+                status_url = url_for("signup_status", job_id=job["id"])
 
                 return jsonify(
                     {
                         "success": True,
-                        "email": res.get("auth0_email"),
+                        "job_id": job["id"],
+                        "status": job["status"],
+                        "status_url": status_url,
                     }
-                )
+                ), 202, {"Location": status_url}
             else:
                 error = True
 
+        except jobs.JobQueueFull:
+            return jsonify({"success": False,
+                            "error": 503,
+                            "message": "too many signups, try again shortly"}), 503, {"Retry-After": "5"}
         except Exception as ex:
             abort(422)
 
@@ -125,9 +170,32 @@ def create_app(test_config=None):
         return render_template('forms/register.html', form=form)
         
 
+    @app.route('/user/create/<job_id>', methods=['GET'])
+    def signup_status(job_id):
+        '''
+        status of a signup job
+        return: status is queued, running, succeeded, failed or timed_out;
+        email once it succeeded
+        '''
+        job = jobs.signup_jobs.get(job_id)
+        if job is None:
+            abort(404)
+
+        result = job["result"] or {}
+        return jsonify(
+            {
+                "success": True,
+                "job_id": job["id"],
+                "status": job["status"],
+                "email": result.get("auth0_email"),
+                "error": job["error"],
+            }
+        )
+
     @app.route('/api/v1/categories')
+    @versions.conditional(catalog.categories_versions)
     def api_get_categories():
-        categories = Category.query.order_by(Category.type).all()
+        categories = catalog.get_categories()
 
         if len(categories) == 0:
             abort(404)
@@ -135,7 +203,7 @@ def create_app(test_config=None):
         return jsonify(
             {
                 "success": True,
-                "categories": {category.id: category.type for category in categories}
+                "categories": categories
             }
         )
     
@@ -143,17 +211,18 @@ def create_app(test_config=None):
     @app.route('/categories/<int:category_id>')
     def get_item_in_category(category_id):
         
-        ret = api_get_item_in_category(category_id)
+        try:
+            category = catalog.get_category(category_id)
+        except Exception as ex:
+            abort(422)
 
-        if (ret.status_code == 404):
+        if category is None:
             return render_template('errors/404.html')
 
-        cur_items = json.loads(ret.get_data())['items']
-        cur_category = json.loads(ret.get_data())['category']
-        
-        return render_template('pages/items_in_category.html', items=cur_items, category=cur_category)
+        return render_template('pages/items_in_category.html', items=category["items"], category=category["category"])
 
     @app.route('/api/v1/categories/<int:category_id>')
+    @versions.conditional(catalog.category_versions)
     def api_get_item_in_category(category_id):
         '''
         get items under the given category
@@ -165,32 +234,25 @@ def create_app(test_config=None):
         list of items
         '''
         try:
-            items = Item.query.filter(Item.category == category_id).all()
-            category_type = Category.query.filter(Category.id == category_id).one_or_none()
+            category = catalog.get_category(category_id)
         except Exception as ex:
             abort(422)
 
-        if len(items) is None or category_type is None:
-            return make_response(jsonify(items), 404)
-        
-        cur_items = []
-        for item in items:
-            cur_items.append({'id':item.id, 'title':item.title, 'brand':item.brand})
+        if category is None:
+            return make_response(jsonify([]), 404)
 
         return jsonify(
             {
                 "success": True,
-                "category": category_type.type,
-                "items": cur_items
+                "category": category["category"],
+                "items": category["items"]
             }
         )
 
     @app.route('/items')
     def get_items():
         
-        ret = api_get_items()
-    
-        cur_items = json.loads(ret.get_data())['data']
+        cur_items = catalog.get_all_items()
         
         if not cur_items: 
             return render_template('errors/404.html')
@@ -199,39 +261,59 @@ def create_app(test_config=None):
 
 
     @app.route('/api/v1/items')
+    @versions.conditional(lambda: [versions.categories_key(), versions.items_key()])
     def api_get_items():
         '''
         get all items in database
         return: "data" :[ {category: "category", items:[{id: "id", title: "t", brand: "b"}, {}]},{}]
         '''
         #items = paginate_items(request)
-        
-        categories = Category.query.order_by(Category.type).all()
-        data = []
-        for category_record in categories:
-            cur_data={}
-            cur_data["category"] = category_record.type
-            cur_items=[]
-            all_items = Item.query.filter(Item.category==category_record.id).all()
-            for item in all_items:
-                cur_items.append({'id':item.id, 'title':item.title, 'brand':item.brand})
-            cur_data["snacks"] = cur_items
-            data.append(cur_data)
 
         return jsonify(
             {
                 "success": True,
-                "data": data,
-                "total_items": len(Item.query.all()),
+                "data": catalog.get_all_items(),
+                "total_items": row_count(Item),
             }
         )
     
+    def export_response(batches, fields, name):
+        export_format = request.args.get("format", "ndjson")
+        if export_format not in export.FORMATS:
+            abort(400)
+
+        response = app.response_class(
+            stream_with_context(export.render(batches, fields, export_format)),
+            mimetype=export.FORMATS[export_format])
+        response.headers["Content-Disposition"] = \
+            "attachment; filename={}.{}".format(name, export_format)
+        return response
+
+    @app.route('/api/v1/export/items')
+    def export_items():
+        '''
+        stream every item with its category, tastes, holidays and rating
+        input: ?format=ndjson (default) or ?format=csv
+        '''
+        return export_response(export.item_batches(), export.ITEM_FIELDS, "items")
+
+    @app.route('/api/v1/export/comments')
+    @requires_auth('post:comments')
+    def export_comments():
+        '''
+        stream every published comment
+        input: ?format=ndjson (default) or ?format=csv
+        '''
+        return export_response(export.comment_batches(), export.COMMENT_FIELDS, "comments")
+
     @app.route('/snack/<int:item_id>')
     def get_an_item(item_id):
         
-        ret = api_an_item(item_id)
-        
-        cur_item = json.loads(ret.get_data())['data']
+        try:
+            cur_item = catalog.get_item(item_id)
+        except Exception as ex:
+            app.logger.exception('loading item %s failed', item_id)
+            cur_item = None
 
         if not cur_item: 
             return render_template('errors/404.html')
@@ -244,54 +326,32 @@ def create_app(test_config=None):
 
 
     @app.route('/api/v1/snack/<int:item_id>')
+    @versions.conditional(catalog.item_versions)
     def api_an_item(item_id):
         """
         get a snack's detail data
 
         input: item_id: int
         """
-        cur_item={}
         try:
-            
-            snack = Item.query.filter(Item.id == item_id).one_or_none()
-            
-            if not snack: 
-                return jsonify(
+            cur_item = catalog.get_item(item_id)
+        except Exception as ex:
+            app.logger.exception('loading item %s failed', item_id)
+            return jsonify(
             {
                 "success": False,
-                "data": {}
+                "data": {},
             }
-        )
-
-            category = Category.query.filter(
-                Category.id == snack.category).one_or_none()
-            tastes = Taste.query.filter(Taste.item == item_id).all()
-            holidays = Holiday.query.filter(Holiday.item == item_id).all()
-
-            combined_taste=[]
-            combined_holiday=[]
-
-            for tst in tastes:
-                combined_taste.append(tst.taste)
-
-            for day in holidays:
-                combined_holiday.append(day.holiday)
-
-            cur_item['title'] = snack.title
-            cur_item['brand'] = snack.brand
-            cur_item['category'] = category.type
-            cur_item['img'] = snack.img
-            cur_item['taste'] = ', '.join(combined_taste)
-            cur_item['holiday'] = ', '.join(combined_holiday)
+        ), 500
 
-        except Exception as ex:
-            print(ex)
+        # not a 200, so no ETag a client could revalidate once the item exists
+        if cur_item is None:
             return jsonify(
             {
                 "success": False,
-                "data": {},
+                "data": {}
             }
-        )
+        ), 404
         
         return jsonify(
             {
@@ -324,25 +384,102 @@ def create_app(test_config=None):
             abort(422)
 
         try:
-            item = Item(title=new_title, brand=new_brand, category=new_category)
+            item = Item(title=new_title, brand=new_brand, category=new_category,
+                        img=body.get("img"))
             item.insert()
-            
-            commit_session()
-            current_items = paginate_items(request)
+            transaction.on_commit(cache.invalidate_item, item.id)
+            transaction.on_commit(cache.invalidate_category, new_category)
+            current_items, next_cursor = paginate_items(request)
 
             return jsonify(
                 {
                     "success": True,
                     "items": current_items,
-                    "total_items": len(Item.query.all()),
+                    "next_cursor": next_cursor,
+                    "total_items": row_count(Item),
                 }
             )
         except Exception as ex:
             abort(422)
         
+    @app.route('/api/v1/items/bulk', methods=["POST"])
+    @requires_auth('post:item')
+    def bulk_create_items():
+        '''
+        create many items in one transaction
+        input: a JSON array, or NDJSON (application/x-ndjson) with one item per line
+        [
+            {
+                title: "",
+                brand: "",
+                category: int,
+                img: "",
+                tastes: [""],
+                holidays: [""]
+            }
+        ]
+        '''
+        try:
+            items = bulk.validate_items(bulk.parse_records(request), app.config["BULK_MAX_ITEMS"])
+        except bulk.BulkError as ex:
+            return jsonify({"success": False,
+                            "error": 422,
+                            "message": "unprocessable",
+                            "errors": ex.errors[:100]}), 422
+
+        try:
+            ids = bulk.import_items(items)
+        except Exception as ex:
+            abort(422)
+
+        transaction.on_commit(bulk.invalidate_items, {item["category"] for item in items})
+
+        return jsonify(
+            {
+                "success": True,
+                "created": len(ids),
+                "ids": ids,
+                "tastes": sum(len(item["tastes"]) for item in items),
+                "holidays": sum(len(item["holidays"]) for item in items),
+            }
+        )
+
     @app.route('/item/search', methods=["POST"])
-    #def search_item():
-        # TODO
+    # a read-only JSON API for clients without the form's CSRF token
+    @csrf.exempt
+    def search_item():
+        '''
+        ranked search over item title, brand, category, tastes and holidays
+        input:
+        {
+            search_term: "",
+            page: int,
+            per_page: int
+        }
+        '''
+        body = request.get_json() or {}
+
+        search_term = (body.get("search_term") or "").strip()
+        if not search_term:
+            abort(422)
+
+        try:
+            page = max(1, int(body.get("page", 1)))
+            per_page = max(1, min(int(body.get("per_page", ITEMS_PER_PAGE)), MAX_PER_PAGE))
+        except (TypeError, ValueError):
+            abort(422)
+
+        items, has_more = search_items(search_term, page, per_page)
+
+        return jsonify(
+            {
+                "success": True,
+                "search_term": search_term,
+                "items": items,
+                "page": page,
+                "has_more": has_more,
+            }
+        )
 
 
     @app.route('/items/<int:item_id>', methods=["PATCH"])
@@ -359,26 +496,27 @@ def create_app(test_config=None):
 
         '''
         body = request.get_json()
-        current_item = Item.query.filter(Item.id == item_id)
+        current_item = Item.query.filter(Item.id == item_id).one_or_none()
         
         if current_item is None:
             abort(404)
 
+        old_category = current_item.category
+
         try:
-            current_item.update({
-                "title": body.get("title", current_item.one_or_none().format().get('title')),
-                "brand": body.get("brand", current_item.one_or_none().format().get('brand')),
-                "category": body.get("category", current_item.one_or_none().format().get('category'))
-                }, synchronize_session='fetch')
-            
-            commit_session()
+            current_item.title = body.get("title", current_item.title)
+            current_item.brand = body.get("brand", current_item.brand)
+            current_item.category = body.get("category", current_item.category)
+            current_item.update()
+            transaction.on_commit(cache.invalidate_item, item_id)
+            transaction.on_commit(cache.invalidate_category, old_category, current_item.category)
 
             return jsonify(
                 {
                     "success": True,
                     "updated": item_id,
-                    "items": current_item.one_or_none().format(),
-                    "total_items": len(Item.query.all()),
+                    "items": current_item.format(),
+                    "total_items": row_count(Item),
                 }
             )
         except Exception as ex:
@@ -397,16 +535,21 @@ def create_app(test_config=None):
         if item is None:
             abort(404)
 
+        category_id = item.category
+
         try:
             item.delete()
-            current_items = paginate_items(request)
+            transaction.on_commit(cache.invalidate_item, item_id)
+            transaction.on_commit(cache.invalidate_category, category_id)
+            current_items, next_cursor = paginate_items(request)
 
             return jsonify(
                 {
                     "success": True,
                     "deleted": item_id,
                     "items": current_items,
-                    "total_items": len(Item.query.all()),
+                    "next_cursor": next_cursor,
+                    "total_items": row_count(Item),
                 }
             )
         except Exception as ex:
@@ -438,15 +581,16 @@ def create_app(test_config=None):
             comment = Temp_comment(comment=new_comment, item=new_item, rating = new_rating, userid = new_userid)
             comment.insert()
             
-            current_comments = paginate_temp_comments(request)
+            current_comments, next_cursor = paginate_temp_comments(request)
             
-            cnt_total_items = len(Temp_comment.query.all())
+            cnt_total_items = row_count(Temp_comment)
             
             return jsonify(
                 {
                     
                     "success": True,
                     "items": current_comments,
+                    "next_cursor": next_cursor,
                     "total_items": cnt_total_items,
                 }
             )
@@ -483,20 +627,60 @@ def create_app(test_config=None):
         try:
             comment = Comment(comment=new_comment, item=updated_item, rating = new_rating, userid = new_userid)
             comment.insert()
-            commit_session()
-            current_comments = paginate_comments(request)
+            transaction.on_commit(ratings.invalidate, [updated_item])
+            current_comments, next_cursor = paginate_comments(request)
 
             return jsonify(
                 {
                     "success": True,
                     "item": updated_item,
                     "comments": current_comments,
-                    "total_comments": len(Comment.query.filter(Comment.item == updated_item).all()),
+                    "next_cursor": next_cursor,
+                    "total_comments": row_count(Comment, item=updated_item),
                 }
             )
         except Exception as ex:
             abort(422)
 
+    @app.route('/admin/comments/moderate', methods=["POST"])
+    @requires_auth('post:comments')
+    def moderate_comments():
+        '''
+        publish or drop pending comments in one transaction
+        input:
+        {
+            approve: [temp comment ids],
+            reject: [temp comment ids]
+        }
+        ids that are no longer pending come back in missing
+        '''
+        try:
+            approve, reject = bulk.validate_moderation(
+                request.get_json(silent=True), app.config["MODERATION_MAX_IDS"])
+        except bulk.BulkError as ex:
+            return jsonify({"success": False,
+                            "error": 422,
+                            "message": "unprocessable",
+                            "errors": ex.errors}), 422
+
+        try:
+            result = bulk.moderate_comments(approve, reject)
+        except Exception as ex:
+            abort(422)
+
+        transaction.on_commit(ratings.invalidate, result["items"])
+
+        return jsonify(
+            {
+                "success": True,
+                "approved": result["approved"],
+                "rejected": result["rejected"],
+                "missing": result["missing"],
+                "total_comments": row_count(Comment),
+                "total_temp_comments": row_count(Temp_comment),
+            }
+        )
+
     @app.route('/temp/comments/<int:comment_id>', methods=["DELETE"])
     @requires_auth('temp_delete:comments')
     def delete_temp_comment(comment_id):
@@ -516,14 +700,15 @@ def create_app(test_config=None):
 
         try:
             comment.delete()
-            current_comments = paginate_temp_comments(request)
+            current_comments, next_cursor = paginate_temp_comments(request)
 
             return jsonify(
                 {
                     "success": True,
                     "deleted": comment_id,
                     "comments": current_comments,
-                    "total_comments": len(Comment.query.all()),
+                    "next_cursor": next_cursor,
+                    "total_comments": row_count(Comment),
                 }
             )
         except Exception as ex:
@@ -543,22 +728,24 @@ def create_app(test_config=None):
         '''
         comment = Comment.query.filter(
             Comment.id == comment_id).one_or_none()
-        print('comment, ', comment)
         if comment is None:
             abort(404)
 
+        commented_item = comment.item
+
         try:
             comment.delete()
-            commit_session()
+            transaction.on_commit(ratings.invalidate, [commented_item])
 
-            current_comments = paginate_comments(request)
+            current_comments, next_cursor = paginate_comments(request)
 
             return jsonify(
                 {
                     "success": True,
                     "deleted": comment_id,
                     "current_comments": current_comments,
-                    "total_comments": len(Comment.query.all())
+                    "next_cursor": next_cursor,
+                    "total_comments": row_count(Comment)
                 }
             )
         except Exception as ex:
@@ -595,11 +782,19 @@ def create_app(test_config=None):
             "success": False,
             "error": ex.status_code,
             'message': ex.error
-        }), 401
+        }), ex.status_code
 
     return app
 
-app = create_app()
+
+def __getattr__(name):
+    # `app.app` (manage.py, gunicorn app:app) is built on first access
+    # instead of at import; the Procfile calls create_app() itself
+    if name == 'app':
+        globals()['app'] = create_app()
+        return globals()['app']
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
 
 if __name__ == '__main__':
-    app.run()
+    create_app().run()
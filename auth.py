@@ -1,8 +1,14 @@
+import hashlib
 import json
+from collections import OrderedDict
 from flask import request, _request_ctx_stack
 from functools import wraps
 import os
-from jose import jwt
+import threading
+import time
+from jose import jwk, jwt
+
+import metrics
 from urllib.request import urlopen
 
 AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN')
@@ -10,6 +16,14 @@ ALGORITHMS = ['RS256']
 API_AUDIENCE = os.getenv('API_AUDIENCE')
 AUTH0_CLIENT_ID = os.getenv('AUTH0_CLIENT_ID')
 
+# JWKS cache settings, all in seconds
+JWKS_TTL = int(os.getenv('JWKS_TTL', 600))
+JWKS_REFRESH_MARGIN = int(os.getenv('JWKS_REFRESH_MARGIN', 60))
+JWKS_MIN_REFRESH_INTERVAL = int(os.getenv('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = float(os.getenv('JWKS_FETCH_TIMEOUT', 5))
+# number of verified tokens kept in memory
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 1024))
+
 ## AuthError Exception
 '''
 AuthError Exception
@@ -69,28 +83,196 @@ def check_permissions(permission, payload):
     
 
 
+## JWKS key store
+'''
+JWKSKeyStore
+Keeps the Auth0 signing keys in process so verifying a token does not
+need an outbound request. Keys are refetched when the TTL runs out, in a
+background thread shortly before that, and on demand when a token names
+a kid we have not seen (rate limited by min_refresh_interval).
+If Auth0 cannot be reached the last known keys keep being used.
+'''
+class JWKSKeyStore:
+    def __init__(self, url, ttl=JWKS_TTL, refresh_margin=JWKS_REFRESH_MARGIN,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 timeout=JWKS_FETCH_TIMEOUT):
+        self.url = url
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._keys = {}
+        self._expires_at = 0
+        self._last_fetch = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def fetch(self):
+        jsonurl = urlopen(self.url, timeout=self.timeout)
+        return json.loads(jsonurl.read())
+
+    def load(self, jwks):
+        '''
+        build the key objects for a JWKS document and make them current
+        '''
+        keys = {}
+        for key in jwks.get('keys', []):
+            if key.get('kty') != 'RSA' or key.get('use', 'sig') != 'sig':
+                continue
+            rsa_key = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key.get('use', 'sig'),
+                'n': key['n'],
+                'e': key['e']
+            }
+            keys[key['kid']] = jwk.construct(rsa_key, ALGORITHMS[0])
+
+        now = time.monotonic()
+        self._keys = keys
+        self._expires_at = now + self.ttl
+        self._last_fetch = now
+
+    def refresh(self, force=False):
+        with self._lock:
+            now = time.monotonic()
+            # another thread may have refreshed while we waited for the lock
+            if force:
+                if now - self._last_fetch < self.min_refresh_interval:
+                    return
+            elif now < self._expires_at - self.refresh_margin:
+                return
+
+            try:
+                self.load(self.fetch())
+            except Exception:
+                if not self._keys:
+                    raise AuthError({
+                        'code': 'jwks_unavailable',
+                        'description': 'Unable to fetch signing keys.'
+                    }, 503)
+                # keep serving the keys we have and retry a bit later
+                self._last_fetch = now
+                self._expires_at = max(self._expires_at,
+                                       now + self.min_refresh_interval)
+
+    def _refresh_in_background(self):
+        if self._refreshing:
+            return
+        self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except AuthError:
+                pass
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def get_key(self, kid):
+        now = time.monotonic()
+        if now >= self._expires_at:
+            self.refresh()
+        elif now >= self._expires_at - self.refresh_margin:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None:
+            # signing keys were probably rotated
+            self.refresh(force=True)
+            key = self._keys.get(kid)
+        return key
+
+
+jwks_store = JWKSKeyStore(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+
+
+## Verified token cache
+'''
+TokenCache
+LRU of already verified tokens, keyed by a sha256 of the token so raw
+tokens are never kept around. A payload is served until the token's exp
+claim; tokens without exp are not cached.
+'''
+class TokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= time.time():
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, token, payload):
+        exp = payload.get('exp')
+        if not isinstance(exp, (int, float)) or self.maxsize <= 0:
+            return
+
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (payload, exp)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'maxsize': self.maxsize
+        }
+
+
+token_cache = TokenCache()
+
+
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    #print('jwks ', jwks)
-    unverified_header = jwt.get_unverified_header(token)
+    payload = token_cache.get(token)
+    if payload is not None:
+        metrics.AUTH_CHECKS.labels('cached').inc()
+        return payload
+
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except jwt.JWTError:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 400)
     #print('unverified_header', unverified_header)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks_store.get_key(unverified_header['kid'])
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -101,6 +283,8 @@ def verify_decode_jwt(token):
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
 
+            token_cache.set(token, payload)
+            metrics.AUTH_CHECKS.labels('verified').inc()
             return payload
 
         except jwt.ExpiredSignatureError:
@@ -130,11 +314,20 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
+            try:
+                token = get_token_auth_header()
+                payload = verify_decode_jwt(token)
+            except AuthError:
+                metrics.AUTH_CHECKS.labels('rejected').inc()
+                raise
             #print('payload ', payload, ' f ', f)
 
-            if check_permissions(permission, payload):
+            try:
+                allowed = check_permissions(permission, payload)
+            except AuthError:
+                metrics.AUTH_CHECKS.labels('forbidden').inc()
+                raise
+            if allowed:
                 return f(*args, **kwargs)
 
         return wrapper
@@ -0,0 +1,449 @@
+'''
+Benchmark every route of create_app() against a generated dataset.
+
+Seeds a SQLite file or a local Postgres database with --scale items and
+their tastes, holidays and comments (datagen.py), then drives each
+route through the Flask test client. Routes behind requires_auth get a locally minted RS256 token
+whose public key is loaded into auth.jwks_store, so Auth0 is never
+called; signups use the local stand-in (SIGNUP_BACKEND=local).
+
+For every route it reports p50/p95/p99 latency, SQL statements per
+request (from the Server-Timing header, QUERY_TIMING is switched on) and
+the peak memory allocated while handling one request (tracemalloc), and
+writes it all to a JSON file. For GET routes answering JSON it also
+times encoding the response payload alone with each fastjson backend and
+with the pretty-printed stdlib output flask.jsonify gave in debug mode,
+the old default. --compare lists routes whose p95 grew by more than
+--threshold against an earlier file and exits with status 1.
+
+usage: python benchmark.py [--scale 1k|100k|1m] [--database URL]
+       [--requests 50] [--output FILE] [--compare OLD_FILE] [--reuse]
+Seeding empties the tables of --database first: point it at a scratch
+database (on Postgres, one upgraded with `python manage.py db upgrade`).
+'''
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import re
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+SCALES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+DEFAULT_DATABASE = 'sqlite:////tmp/fsnd-benchmark.db'
+ISSUER_DOMAIN = 'benchmark.local'
+AUDIENCE = 'fsnd-benchmark'
+PERMISSIONS = ['post:item', 'patch:item', 'delete:item', 'temp_post:comments',
+               'temp_delete:comments', 'post:comments', 'delete:comments']
+# routes that cannot run without the real Auth0 tenant
+SKIPPED = {
+    'login': 'redirects to the Auth0 login page',
+    'callback': 'exchanges an Auth0 authorization code',
+}
+_queries = re.compile(r'desc="(\d+) queries"')
+
+
+def configure_environment(database):
+    # read by config.py and auth.py at import time
+    os.environ['DATABASE_URL'] = database
+    os.environ['QUERY_TIMING'] = 'true'
+    os.environ['SIGNUP_BACKEND'] = 'local'
+    # a scratch database gets its tables from create_all()
+    os.environ.setdefault('DB_CREATE_ALL', 'true')
+    os.environ.setdefault('JOBS_QUEUE_SIZE', '100000')
+    os.environ['AUTH0_DOMAIN'] = ISSUER_DOMAIN
+    os.environ['API_AUDIENCE'] = AUDIENCE
+
+
+## Data
+def make_rows(db, model, count, **values):
+    '''
+    insert count rows for routes that consume them (deletes, moderation)
+    return: their ids
+    '''
+    rows = [model(**values) for _ in range(count)]
+    db.session.add_all(rows)
+    db.session.commit()
+    return [row.id for row in rows]
+
+
+## Auth
+def mint_token():
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from jose import jwk, jwt
+    import auth
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption())
+    public_jwk = jwk.construct(pem, 'RS256').public_key().to_dict()
+    public_jwk.update({'kid': 'benchmark', 'use': 'sig'})
+    auth.jwks_store.load({'keys': [public_jwk]})
+
+    claims = {
+        'iss': 'https://{}/'.format(ISSUER_DOMAIN),
+        'aud': AUDIENCE,
+        'sub': 'benchmark|1',
+        'exp': int(time.time()) + 24 * 3600,
+        'permissions': PERMISSIONS,
+    }
+    return jwt.encode(claims, pem, algorithm='RS256', headers={'kid': 'benchmark'})
+
+
+## Routes
+class Route:
+    '''
+    endpoint: Flask endpoint name
+    build(i, ctx) -> (url, test client kwargs) for the i-th request
+    prepare(db, count, ctx): optional, creates what count requests consume
+    repeat: fraction of --requests to send, for the full-table routes
+    '''
+    def __init__(self, endpoint, method, build, prepare=None, auth=False, repeat=1.0):
+        self.endpoint = endpoint
+        self.method = method
+        self.build = build
+        self.prepare = prepare
+        self.auth = auth
+        self.repeat = repeat
+
+
+def _item(ctx):
+    return ctx['rng'].randint(1, ctx['items'])
+
+
+def _category(ctx):
+    return ctx['rng'].randint(1, ctx['categories'])
+
+
+def _new_item(i, ctx):
+    return {'title': 'Bench {}'.format(i), 'brand': 'Bench',
+            'category': 1 + i % ctx['categories'], 'img': 'snack'}
+
+
+def _prepare_items(db, count, ctx):
+    from models import Item
+    ctx['delete_items'] = make_rows(db, Item, count, title='doomed', brand='Bench',
+                                    category=1, img='snack')
+
+
+def _prepare_temp_comments(key, per_request):
+    def prepare(db, count, ctx):
+        from models import Temp_comment
+        ctx[key] = make_rows(db, Temp_comment, count * per_request, comment='pending',
+                             rating=4, item=_item(ctx), userid=1)
+    return prepare
+
+
+def _prepare_comments(db, count, ctx):
+    from models import Comment
+    ctx['delete_comments'] = make_rows(db, Comment, count, comment='doomed',
+                                       rating=3, item=_item(ctx), userid=1)
+
+
+def _prepare_signup_job(db, count, ctx):
+    import jobs
+    import user
+    ctx['job_id'] = jobs.signup_jobs.submit(
+        'signup', user.auth0_create_user, 'status@benchmark.local', 'Secret123')['id']
+
+
+MODERATION_BATCH = 10
+
+ROUTES = [
+    Route('index', 'GET', lambda i, ctx: ('/', {})),
+    Route('get_home', 'GET', lambda i, ctx: ('/home', {})),
+    Route('logout', 'GET', lambda i, ctx: ('/logout', {})),
+    Route('signup', 'GET', lambda i, ctx: ('/user/create', {})),
+    Route('post_signup', 'POST', lambda i, ctx: ('/user/create', {'data': {
+        'username': 'bench{}'.format(i), 'email': 'bench{}@benchmark.local'.format(i),
+        'password': 'Secret123', 'confirm': 'Secret123'}})),
+    Route('signup_status', 'GET', lambda i, ctx: ('/user/create/{}'.format(ctx['job_id']), {}),
+          prepare=_prepare_signup_job),
+    Route('static', 'GET', lambda i, ctx: ('/static/css/main.css', {})),
+    Route('prometheus_metrics', 'GET', lambda i, ctx: ('/metrics', {})),
+
+    Route('api_get_categories', 'GET', lambda i, ctx: ('/api/v1/categories', {})),
+    Route('get_item_in_category', 'GET',
+          lambda i, ctx: ('/categories/{}'.format(_category(ctx)), {})),
+    Route('api_get_item_in_category', 'GET',
+          lambda i, ctx: ('/api/v1/categories/{}'.format(_category(ctx)), {})),
+    Route('get_items', 'GET', lambda i, ctx: ('/items', {}), repeat=0.2),
+    Route('api_get_items', 'GET', lambda i, ctx: ('/api/v1/items', {}), repeat=0.2),
+    Route('get_an_item', 'GET', lambda i, ctx: ('/snack/{}'.format(_item(ctx)), {})),
+    Route('api_an_item', 'GET', lambda i, ctx: ('/api/v1/snack/{}'.format(_item(ctx)), {})),
+    Route('search_item', 'POST', lambda i, ctx: ('/item/search', {'json': {
+        'search_term': ctx['rng'].choice(['barbecue chips', 'salty', 'chocolat', 'golden farms'])}})),
+    Route('export_items', 'GET', lambda i, ctx: ('/api/v1/export/items', {}), repeat=0.1),
+    Route('export_comments', 'GET', lambda i, ctx: ('/api/v1/export/comments', {}),
+          auth=True, repeat=0.1),
+
+    Route('create_item', 'POST', lambda i, ctx: ('/items', {'json': _new_item(i, ctx)}), auth=True),
+    Route('bulk_create_items', 'POST', lambda i, ctx: ('/api/v1/items/bulk', {
+        'json': [_new_item(i * 100 + n, ctx) for n in range(100)]}), auth=True),
+    Route('modify_item', 'PATCH', lambda i, ctx: ('/items/{}'.format(_item(ctx)), {
+        'json': {'brand': 'Brand {}'.format(i)}}), auth=True),
+    Route('delete_item', 'DELETE',
+          lambda i, ctx: ('/items/{}'.format(ctx['delete_items'][i]), {}),
+          prepare=_prepare_items, auth=True),
+    Route('add_temp_comment', 'POST', lambda i, ctx: ('/user/comments', {'json': {
+        'comment': 'bench', 'item': _item(ctx), 'rating': 4, 'userid': 1}}), auth=True),
+    Route('add_comment', 'POST', lambda i, ctx: ('/admin/comments/{}'.format(i), {'json': {
+        'comment': 'bench', 'item': _item(ctx), 'rating': 5, 'userid': 1}}), auth=True),
+    Route('moderate_comments', 'POST', lambda i, ctx: ('/admin/comments/moderate', {'json': {
+        'approve': ctx['moderate'][i * MODERATION_BATCH:(i + 1) * MODERATION_BATCH]}}),
+          prepare=_prepare_temp_comments('moderate', MODERATION_BATCH), auth=True),
+    Route('delete_temp_comment', 'DELETE',
+          lambda i, ctx: ('/temp/comments/{}'.format(ctx['delete_temp'][i]), {}),
+          prepare=_prepare_temp_comments('delete_temp', 1), auth=True),
+    Route('delete_comment', 'DELETE',
+          lambda i, ctx: ('/admin/comments/{}'.format(ctx['delete_comments'][i]), {}),
+          prepare=_prepare_comments, auth=True),
+]
+
+
+## Measuring
+def percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100.0 * len(ordered)) - 1)]
+
+
+def send(client, route, i, ctx, headers):
+    url, kwargs = route.build(i, ctx)
+    started = time.perf_counter()
+    response = client.open(url, method=route.method,
+                           headers=headers if route.auth else None, **kwargs)
+    # drain streamed bodies so the whole response is timed
+    response.get_data()
+    elapsed = time.perf_counter() - started
+    match = _queries.search(' '.join(response.headers.getlist('Server-Timing')))
+    return response.status_code, elapsed, int(match.group(1)) if match else None
+
+
+def run_route(app, db, route, requests, ctx, headers):
+    count = max(1, int(requests * route.repeat))
+    memory_runs = min(count, 5)
+    # a few warm-up requests fill caches and compiled statement caches
+    warmup = min(3, count)
+    if route.prepare is not None:
+        with app.app_context():
+            route.prepare(db, warmup + count + memory_runs, ctx)
+
+    client = app.test_client()
+    for i in range(warmup):
+        send(client, route, i, ctx, headers)
+
+    latencies, queries, statuses = [], [], {}
+    for i in range(warmup, warmup + count):
+        status, elapsed, statements = send(client, route, i, ctx, headers)
+        latencies.append(elapsed * 1000)
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        if statements is not None:
+            queries.append(statements)
+
+    # memory in a separate pass, tracemalloc slows every allocation down
+    peaks = []
+    tracemalloc.start()
+    for i in range(warmup + count, warmup + count + memory_runs):
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        send(client, route, i, ctx, headers)
+        peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+
+    return {
+        'method': route.method,
+        'requests': count,
+        'statuses': statuses,
+        'errors': sum(n for status, n in statuses.items() if status.startswith('5')),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'mean_ms': round(statistics.mean(latencies), 3),
+        'queries_per_request': round(statistics.mean(queries), 2) if queries else None,
+        'max_queries': max(queries) if queries else None,
+        'peak_memory_kb': round(max(peaks) / 1024, 1),
+    }
+
+
+# encoders compared per JSON response
+ENCODERS = {
+    'debug_pretty': {'backend': 'stdlib', 'pretty': True},
+    'stdlib': {'backend': 'stdlib'},
+    'orjson': {'backend': 'orjson'},
+}
+# time spent encoding one payload with each encoder
+SERIALIZATION_BUDGET = 0.05
+
+
+def serialization_cost(app, route, ctx, headers):
+    '''
+    time encoding the payload a GET route passes to jsonify
+    return: {encoder: {us, bytes}}, or None for routes without JSON
+    '''
+    import fastjson
+
+    captured = []
+    dumps = fastjson.dumps
+
+    def capture(value, **kwargs):
+        captured.append(value)
+        return dumps(value, **kwargs)
+
+    fastjson.dumps = capture
+    try:
+        send(app.test_client(), route, 0, ctx, headers)
+    finally:
+        fastjson.dumps = dumps
+    if not captured:
+        return None
+
+    costs = {}
+    for name, options in ENCODERS.items():
+        if options['backend'] == 'orjson' and fastjson.orjson is None:
+            continue
+        runs, started = 0, time.perf_counter()
+        while runs < 5 or time.perf_counter() - started < SERIALIZATION_BUDGET:
+            body = dumps(captured[-1], **options)
+            runs += 1
+        costs[name] = {
+            'us': round((time.perf_counter() - started) / runs * 1e6, 1),
+            'bytes': len(body),
+        }
+    return costs
+
+
+def compare(results, path, threshold):
+    with open(path) as previous_file:
+        previous = json.load(previous_file)['routes']
+
+    regressions = []
+    for endpoint, current in results['routes'].items():
+        before = previous.get(endpoint)
+        if before and before['p95_ms'] and current['p95_ms'] > before['p95_ms'] * (1 + threshold):
+            regressions.append((endpoint, before['p95_ms'], current['p95_ms']))
+        if before and (current['queries_per_request'] or 0) > (before['queries_per_request'] or 0):
+            regressions.append((endpoint + ' queries', before['queries_per_request'],
+                                current['queries_per_request']))
+    return regressions
+
+
+def report(results):
+    print('{:<26} {:>6} {:>9} {:>9} {:>9} {:>8} {:>10}  statuses'.format(
+        'route', 'method', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'peak KiB'))
+    for endpoint, stats in sorted(results['routes'].items()):
+        print('{:<26} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>8} {:>10.1f}  {}'.format(
+            endpoint, stats['method'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+            stats['queries_per_request'] if stats['queries_per_request'] is not None else '-',
+            stats['peak_memory_kb'], stats['statuses']))
+    for endpoint, reason in sorted(results['skipped'].items()):
+        print('{:<26} skipped: {}'.format(endpoint, reason))
+
+    encoders = list(ENCODERS)
+    print()
+    print('{:<26} '.format('JSON encoding, us (bytes)')
+          + ' '.join('{:>20}'.format(name) for name in encoders))
+    for endpoint, stats in sorted(results['routes'].items()):
+        costs = stats.get('serialization')
+        if not costs:
+            continue
+        print('{:<26} '.format(endpoint) + ' '.join(
+            '{:>20}'.format('{} ({})'.format(costs[name]['us'], costs[name]['bytes'])
+                            if name in costs else '-') for name in encoders))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scale', default='1k',
+                        help='1k, 100k, 1m or a number of items')
+    parser.add_argument('--database', default=DEFAULT_DATABASE)
+    parser.add_argument('--requests', type=int, default=50,
+                        help='measured requests per route')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--reuse', action='store_true',
+                        help='keep the data already in --database')
+    parser.add_argument('--output')
+    parser.add_argument('--compare', help='earlier results to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed p95 growth with --compare, 0.2 = 20%%')
+    args = parser.parse_args()
+
+    items = SCALES.get(args.scale.lower()) or int(args.scale)
+    configure_environment(args.database)
+
+    from app import create_app
+    from config import db
+    import datagen
+
+    app = create_app()
+    app.config['WTF_CSRF_ENABLED'] = False
+    rng = random.Random(args.seed)
+
+    with app.app_context():
+        if not args.reuse:
+            started = time.perf_counter()
+            datagen.populate(items, args.seed)
+            print('seeded {} items in {:.1f}s'.format(items, time.perf_counter() - started))
+        from models import Item
+        items = db.session.query(db.func.max(Item.id)).scalar() or 0
+
+    headers = {'Authorization': 'Bearer ' + mint_token()}
+    ctx = {'rng': rng, 'items': items, 'categories': len(datagen.CATEGORIES)}
+    results = {
+        'meta': {
+            'scale': args.scale,
+            'items': items,
+            'database': app.config['SQLALCHEMY_DATABASE_URI'].split('://')[0],
+            'requests': args.requests,
+            'seed': args.seed,
+            'python': platform.python_version(),
+            'started': datetime.now(timezone.utc).isoformat(),
+        },
+        'routes': {},
+        'skipped': {},
+    }
+
+    covered = {route.endpoint for route in ROUTES}
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint in SKIPPED:
+            results['skipped'][rule.endpoint] = SKIPPED[rule.endpoint]
+        elif rule.endpoint not in covered:
+            results['skipped'][rule.endpoint] = 'no benchmark defined in benchmark.ROUTES'
+
+    for route in ROUTES:
+        if route.endpoint not in app.view_functions:
+            continue
+        results['routes'][route.endpoint] = run_route(
+            app, db, route, args.requests, ctx, headers)
+        if route.method == 'GET':
+            results['routes'][route.endpoint]['serialization'] = serialization_cost(
+                app, route, ctx, headers)
+
+    # ru_maxrss is in KiB on Linux
+    results['meta']['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    report(results)
+
+    output = args.output or 'benchmark-{}-{}.json'.format(
+        args.scale, datetime.now().strftime('%Y%m%d-%H%M%S'))
+    with open(output, 'w') as output_file:
+        json.dump(results, output_file, indent=2, sort_keys=True)
+    print('results written to', output)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        for name, before, after in regressions:
+            print('REGRESSION {}: {} -> {}'.format(name, before, after))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
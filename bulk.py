@@ -0,0 +1,304 @@
+'''
+Bulk writes that bypass the ORM unit of work.
+
+Rows go in as multi-row statements (COPY on Postgres, executemany
+elsewhere) inside the caller's transaction. These writes skip the
+after_flush hooks, so every function here updates the counters, version
+stamps and cache itself.
+'''
+import io
+import json
+
+from sqlalchemy import delete, insert, select, text
+
+import cache
+import counters
+import ratings
+import search
+import versions
+from config import db
+from models import Category, Item, Taste, Holiday, Temp_comment, Comment
+
+BULK_CHUNK_SIZE = 5000
+
+
+class BulkError(Exception):
+    def __init__(self, errors):
+        self.errors = errors
+
+
+## Input
+def parse_records(request):
+    '''
+    a JSON array (or {"items": [...]}) or NDJSON, one object per line
+    '''
+    if request.mimetype in ('application/x-ndjson', 'application/jsonlines'):
+        records = []
+        for number, line in enumerate(request.get_data(as_text=True).splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                raise BulkError([{'line': number, 'error': 'invalid JSON'}])
+        return records
+
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        body = body.get('items')
+    if not isinstance(body, list):
+        raise BulkError([{'error': 'expected a JSON array or NDJSON body'}])
+    return body
+
+
+def _id_list(value):
+    return isinstance(value, list) and all(type(v) is int for v in value)
+
+
+def validate_moderation(body, max_ids):
+    '''
+    return: (ids to approve, ids to reject)
+    '''
+    if not isinstance(body, dict):
+        raise BulkError([{'error': 'expected an object'}])
+
+    errors = [{'field': field, 'error': 'must be a list of comment ids'}
+              for field in ('approve', 'reject') if not _id_list(body.get(field, []))]
+    if errors:
+        raise BulkError(errors)
+
+    approve = set(body.get('approve', []))
+    reject = set(body.get('reject', []))
+    if approve & reject:
+        raise BulkError([{'error': 'ids both approved and rejected',
+                          'ids': sorted(approve & reject)}])
+    if not approve and not reject:
+        raise BulkError([{'error': 'no comment ids'}])
+    if len(approve) + len(reject) > max_ids:
+        raise BulkError([{'error': 'at most {} comments per request'.format(max_ids)}])
+    return sorted(approve), sorted(reject)
+
+
+def _string_list(value):
+    return isinstance(value, list) and all(isinstance(v, str) and v for v in value)
+
+
+def validate_items(records, max_items):
+    '''
+    check every record before anything is written
+    return: list of clean item dicts
+    '''
+    if not records:
+        raise BulkError([{'error': 'no items'}])
+    if len(records) > max_items:
+        raise BulkError([{'error': 'at most {} items per request'.format(max_items)}])
+
+    errors = []
+    items = []
+    for index, record in enumerate(records):
+        if not isinstance(record, dict):
+            errors.append({'index': index, 'error': 'expected an object'})
+            continue
+
+        problems = []
+        for field in ('title', 'brand'):
+            if not isinstance(record.get(field), str) or not record[field].strip():
+                problems.append('{} is required'.format(field))
+        if type(record.get('category')) is not int:
+            problems.append('category must be an integer')
+        if record.get('img') is not None and not isinstance(record['img'], str):
+            problems.append('img must be a string')
+        for field in ('tastes', 'holidays'):
+            if not _string_list(record.get(field, [])):
+                problems.append('{} must be a list of strings'.format(field))
+
+        if problems:
+            errors.append({'index': index, 'error': ', '.join(problems)})
+            continue
+
+        items.append({
+            'title': record['title'],
+            'brand': record['brand'],
+            'category': record['category'],
+            'img': record.get('img'),
+            'tastes': record.get('tastes', []),
+            'holidays': record.get('holidays', []),
+        })
+
+    if not errors:
+        wanted = {item['category'] for item in items}
+        known = set(db.session.execute(
+            select(Category.id).where(Category.id.in_(wanted))).scalars())
+        errors = [{'index': index, 'error': 'unknown category {}'.format(item['category'])}
+                  for index, item in enumerate(items) if item['category'] not in known]
+
+    if errors:
+        raise BulkError(errors)
+    return items
+
+
+## Writing
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def copy_rows(connection, table, columns, rows):
+    '''
+    COPY rows (tuples in columns order) into table on a Postgres connection
+    '''
+    cursor = connection.connection.cursor()
+    statement = 'COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns))
+    buffer = io.StringIO()
+    count = 0
+    for row in rows:
+        buffer.write('\t'.join(_copy_value(value) for value in row))
+        buffer.write('\n')
+        count += 1
+        if count % BULK_CHUNK_SIZE == 0:
+            buffer.seek(0)
+            cursor.copy_expert(statement, buffer)
+            buffer = io.StringIO()
+    if buffer.tell():
+        buffer.seek(0)
+        cursor.copy_expert(statement, buffer)
+
+
+def insert_rows(connection, model, rows):
+    '''
+    rows: list of dicts; COPY on Postgres, chunked executemany elsewhere
+    '''
+    if not rows:
+        return
+    if connection.dialect.name == 'postgresql':
+        columns = list(rows[0])
+        copy_rows(connection, model.__tablename__, columns,
+                  (tuple(row[column] for column in columns) for row in rows))
+        return
+    for start in range(0, len(rows), BULK_CHUNK_SIZE):
+        connection.execute(insert(model.__table__), rows[start:start + BULK_CHUNK_SIZE])
+
+
+def _reserve_item_ids(connection, count):
+    if connection.dialect.name == 'postgresql':
+        return list(connection.execute(text(
+            "SELECT nextval(pg_get_serial_sequence('items', 'id')) "
+            "FROM generate_series(1, :count)"), {'count': count}).scalars())
+    return None
+
+
+def import_items(items):
+    '''
+    insert validated items with their tastes and holidays in the current
+    transaction; the caller commits
+    return: list of new item ids, in input order
+    '''
+    connection = db.session.connection()
+    ids = _reserve_item_ids(connection, len(items))
+    rows = [{'title': item['title'], 'brand': item['brand'],
+             'category': item['category'], 'img': item['img']} for item in items]
+
+    if ids is not None:
+        for row, item_id in zip(rows, ids):
+            row['id'] = item_id
+        insert_rows(connection, Item, rows)
+    else:
+        # no sequence to draw from, let the database assign the ids
+        db.session.bulk_insert_mappings(Item, rows, return_defaults=True)
+        ids = [row['id'] for row in rows]
+
+    insert_rows(connection, Taste, [
+        {'taste': taste, 'item': item_id}
+        for item, item_id in zip(items, ids) for taste in item['tastes']])
+    insert_rows(connection, Holiday, [
+        {'holiday': holiday, 'item': item_id}
+        for item, item_id in zip(items, ids) for holiday in item['holidays']])
+
+    categories = {item['category'] for item in items}
+    if counters.counter_table_enabled():
+        counters.adjust(connection, {(Item, counters.TABLE_SCOPE): len(ids)})
+    # the new ids too: a client may hold the ETag of an earlier miss
+    versions.bump(connection, [versions.items_key()] + search.search_keys()
+                  + [versions.category_key(category_id) for category_id in categories]
+                  + [versions.item_key(item_id) for item_id in ids])
+    return ids
+
+
+def invalidate_items(categories):
+    '''
+    drop the cached listings after the import committed
+    '''
+    cache.invalidate_category(*categories)
+
+
+def _id_chunks(connection, ids):
+    # keeps every IN list under the bound parameter limit (999 on older SQLite)
+    size = BULK_CHUNK_SIZE if connection.dialect.name == 'postgresql' else versions.IN_LIST_SIZE
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def moderate_comments(approve, reject):
+    '''
+    move approved temp comments into comments and drop the rejected ones,
+    in the current transaction; the caller commits
+    return: {approved: int, rejected: int, missing: [ids], items: [item ids]}
+    '''
+    connection = db.session.connection()
+    temp = Temp_comment.__table__
+    comments = Comment.__table__
+    wanted = sorted(approve + reject)
+
+    # lock the pending rows so a concurrent moderator cannot move them twice
+    pending = []
+    for chunk in _id_chunks(connection, wanted):
+        pending += connection.execute(
+            select(temp.c.id, temp.c.item, temp.c.rating).where(temp.c.id.in_(chunk))
+            .order_by(temp.c.id).with_for_update()).all()
+    found = {comment_id: item for comment_id, item, _ in pending}
+    scores = {comment_id: rating for comment_id, _, rating in pending}
+    approved = [comment_id for comment_id in approve if comment_id in found]
+    rejected = [comment_id for comment_id in reject if comment_id in found]
+    approved_ids = set(approved)
+
+    for chunk in _id_chunks(connection, approved):
+        connection.execute(insert(comments).from_select(
+            ['comment', 'rating', 'item', 'userid'],
+            select(temp.c.comment, temp.c.rating, temp.c.item, temp.c.userid)
+            .where(temp.c.id.in_(chunk)).order_by(temp.c.id)))
+    for chunk in _id_chunks(connection, sorted(approved + rejected)):
+        connection.execute(delete(temp).where(temp.c.id.in_(chunk)))
+
+    published = ratings.Deltas()
+    for comment_id in approved:
+        published.add(found[comment_id], scores[comment_id], 1)
+
+    deltas = {}
+
+    def step(model, scope, delta):
+        deltas[(model, scope)] = deltas.get((model, scope), 0) + delta
+
+    for comment_id in approved + rejected:
+        item = found[comment_id]
+        step(Temp_comment, counters.TABLE_SCOPE, -1)
+        step(Temp_comment, item, -1)
+        if comment_id in approved_ids:
+            step(Comment, counters.TABLE_SCOPE, 1)
+            step(Comment, item, 1)
+
+    items = sorted({found[comment_id] for comment_id in approved + rejected} - {None})
+    if counters.counter_table_enabled():
+        counters.adjust(connection, {key: delta for key, delta in deltas.items()
+                                     if key[1] is not None})
+    ratings.apply(connection, published)
+    versions.bump(connection, [versions.item_key(item) for item in items]
+                  + versions.rating_keys(connection, [found[comment_id] for comment_id in approved]))
+
+    return {
+        'approved': len(approved),
+        'rejected': len(rejected),
+        'missing': [comment_id for comment_id in wanted if comment_id not in found],
+        'items': items,
+    }
@@ -0,0 +1,255 @@
+'''
+Read-through cache for catalog payloads.
+
+Item details and category maps are cached under the keys built by the
+*_key helpers below, each entry with the version stamps it was loaded at
+(see catalog.py). A read whose current stamps differ reloads the entry.
+The stamps live in the database, so a write is seen by every worker on
+its next read, whatever backend holds the entries.
+
+The invalidate_* helpers, which the write endpoints call after they
+commit, only free the writer's entries early. Entries stored without a
+stamp rely on them and on the TTL: with the local backend another worker
+can serve such an entry for up to CACHE_TTL seconds after a write.
+
+The default backend is an in-process LRU with a TTL. CACHE_BACKEND in
+config.py picks another one: redis (with CACHE_URL) shares entries
+between gunicorn workers, and memory runs the same shared code path
+against MemoryClient, a local stand-in for the redis client.
+'''
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+CACHE_TTL = int(os.getenv('CACHE_TTL', 300))
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 4096))
+# how long a request waits for another one loading the same key
+CACHE_LOAD_TIMEOUT = float(os.getenv('CACHE_LOAD_TIMEOUT', 10))
+
+MISSING = object()
+
+
+def item_key(item_id):
+    return 'item:{}'.format(item_id)
+
+
+def category_key(category_id):
+    return 'category:{}'.format(category_id)
+
+
+CATEGORIES_KEY = 'categories'
+
+
+class LocalBackend:
+    '''
+    LRU with a TTL per entry, private to this process
+    '''
+    def __init__(self, maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SharedBackend:
+    '''
+    cache shared between processes through a redis-like client
+    (get, set with ex=, delete). Values are stored as JSON.
+    '''
+    def __init__(self, client, ttl=CACHE_TTL, prefix='fsnd:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            return MISSING
+        return json.loads(raw)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+class MemoryClient:
+    '''
+    in-memory stand-in for the parts of redis.Redis that SharedBackend uses
+    '''
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            entry = self._data.get(name)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= time.monotonic():
+                del self._data[name]
+                return None
+            return entry[0]
+
+    def set(self, name, value, ex=None):
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        expires_at = time.monotonic() + ex if ex else None
+        with self._lock:
+            self._data[name] = (value, expires_at)
+        return True
+
+    def delete(self, *names):
+        with self._lock:
+            return sum(self._data.pop(name, None) is not None for name in names)
+
+    def scan_iter(self, match='*'):
+        prefix = match.rstrip('*')
+        with self._lock:
+            return [name for name in self._data if name.startswith(prefix)]
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = MISSING
+        # set by Cache.delete() when the key is invalidated during the load
+        self.stale = False
+
+
+class Cache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, loader, stamp=None):
+        '''
+        cached value of key, calling loader() on a miss.
+        stamp: the version the value must have been loaded at, an entry
+        stored with another stamp is a miss
+        Concurrent misses on the same key share a single loader() call.
+        '''
+        entry = self.backend.get(key)
+        if entry is not MISSING and entry[0] == stamp:
+            self.hits += 1
+            metrics.CACHE_LOOKUPS.labels('hit').inc()
+            return entry[1]
+        self.misses += 1
+        metrics.CACHE_LOOKUPS.labels('miss').inc()
+
+        with self._lock:
+            flight = self._flights.get((key, stamp))
+            leader = flight is None
+            if leader:
+                flight = self._flights[(key, stamp)] = _Flight()
+
+        if not leader:
+            flight.done.wait(CACHE_LOAD_TIMEOUT)
+            if flight.value is not MISSING:
+                return flight.value
+            # the leader failed or is too slow, load it ourselves
+            return loader()
+
+        try:
+            value = loader()
+            flight.value = value
+            with self._lock:
+                # skip the store if the key was invalidated while loading;
+                # misses (None) are not kept, the row may be inserted later
+                # without its stamp moving (bulk.import_items)
+                if value is not None and not flight.stale:
+                    self.backend.set(key, [stamp, value])
+            return value
+        finally:
+            with self._lock:
+                self._flights.pop((key, stamp), None)
+            flight.done.set()
+
+    def delete(self, *keys):
+        with self._lock:
+            # only loads in flight need to know, nothing is kept per key
+            for (key, stamp), flight in self._flights.items():
+                if key in keys:
+                    flight.stale = True
+        metrics.CACHE_INVALIDATIONS.inc(len(keys))
+        self.backend.delete(*keys)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+catalog_cache = Cache(LocalBackend())
+
+
+def make_backend(name, url=None, ttl=CACHE_TTL, prefix='fsnd:'):
+    if name == 'redis':
+        import redis
+        return SharedBackend(redis.Redis.from_url(url), ttl=ttl, prefix=prefix)
+    if name == 'memory':
+        return SharedBackend(MemoryClient(), ttl=ttl, prefix=prefix)
+    return LocalBackend(ttl=ttl)
+
+
+def init_app(app):
+    catalog_cache.backend = make_backend(app.config.get('CACHE_BACKEND', 'local'),
+                                         app.config.get('CACHE_URL'))
+
+
+def get_or_load(key, loader, stamp=None):
+    return catalog_cache.get_or_load(key, loader, stamp)
+
+
+def invalidate_item(*item_ids):
+    catalog_cache.delete(*[item_key(item_id) for item_id in item_ids])
+
+
+def invalidate_category(*category_ids):
+    catalog_cache.delete(*[category_key(category_id) for category_id in set(category_ids)])
+
+
+def invalidate_categories():
+    catalog_cache.delete(CATEGORIES_KEY)
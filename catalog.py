@@ -0,0 +1,136 @@
+'''
+Catalog reads shared by the /api/v1 endpoints and the HTML pages.
+
+Every function returns plain lists and dicts; the API views jsonify them
+and the page views hand them straight to the templates.
+
+Cached payloads are checked against the version stamps their ETag is
+made of (versions.py), listed by the *_versions helpers below.
+'''
+from itertools import groupby
+
+from sqlalchemy.orm import joinedload
+
+import cache
+import ratings
+import versions
+from config import db
+from models import Category, Item, ItemRating
+
+
+def categories_versions():
+    return [versions.categories_key()]
+
+
+def category_versions(category_id):
+    return [versions.category_key(category_id)]
+
+
+def item_versions(item_id):
+    # the category name is part of the payload
+    return [versions.item_key(item_id), versions.categories_key()]
+
+
+def get_categories():
+    '''
+    return: {id: type} ordered by type
+    '''
+    def load_categories():
+        categories = Category.query.order_by(Category.type).all()
+        return [[category.id, category.type] for category in categories]
+
+    categories = cache.get_or_load(cache.CATEGORIES_KEY, load_categories,
+                                   versions.version_tag(categories_versions()))
+    return {category_id: category_type for category_id, category_type in categories}
+
+
+def get_category(category_id):
+    '''
+    return: {category: "type", items: [{id, title, brand, rating, reviews}]}
+    or None if the category does not exist
+    '''
+    def load_category():
+        category_type = Category.query.filter(Category.id == category_id).one_or_none()
+        if category_type is None:
+            return None
+
+        rows = db.session.query(
+            Item.id, Item.title, Item.brand, ItemRating.count, ItemRating.total
+            ).outerjoin(ItemRating, ItemRating.item == Item.id
+            ).filter(Item.category == category_id).all()
+        cur_items = []
+        for item_id, title, brand, count, total in rows:
+            cur_item = {'id':item_id, 'title':title, 'brand':brand}
+            cur_item.update(ratings.summary(count, total))
+            cur_items.append(cur_item)
+        return {"category": category_type.type, "items": cur_items}
+
+    return cache.get_or_load(cache.category_key(category_id), load_category,
+                             versions.version_tag(category_versions(category_id)))
+
+
+def get_all_items():
+    '''
+    return: [{category: "type", snacks: [{id, title, brand, rating, reviews}]}]
+    ordered by type
+    '''
+    # one round trip for every category, its items and their ratings,
+    # grouped below
+    rows = db.session.query(
+        Category.id, Category.type, Item.id, Item.title, Item.brand,
+        ItemRating.count, ItemRating.total
+        ).outerjoin(Item, Item.category == Category.id
+        ).outerjoin(ItemRating, ItemRating.item == Item.id
+        ).order_by(Category.type, Category.id, Item.id).all()
+
+    data = []
+    for (_, category_type), group in groupby(rows, key=lambda row: row[:2]):
+        cur_items = []
+        for _, _, item_id, title, brand, count, total in group:
+            if item_id is not None:
+                cur_item = {'id':item_id, 'title':title, 'brand':brand}
+                cur_item.update(ratings.summary(count, total))
+                cur_items.append(cur_item)
+        data.append({"category": category_type, "snacks": cur_items})
+    return data
+
+
+def get_item(item_id):
+    '''
+    return: {title, brand, category, img, taste, holiday,
+    rating, reviews, rating_histogram}
+    or None if the item does not exist
+    '''
+    def load_item():
+        # item, category, tastes, holidays and rating in one statement
+        snack = Item.query.options(
+            joinedload(Item.category_record),
+            joinedload(Item.tastes),
+            joinedload(Item.holidays),
+            joinedload(Item.rating)
+            ).filter(Item.id == item_id).one_or_none()
+
+        if not snack:
+            return None
+
+        combined_taste = [tst.taste for tst in snack.tastes]
+        combined_holiday = [day.holiday for day in snack.holidays]
+
+        cur_item = {}
+        cur_item['title'] = snack.title
+        cur_item['brand'] = snack.brand
+        cur_item['category'] = snack.category_record.type
+        cur_item['img'] = snack.img
+        cur_item['taste'] = ', '.join(combined_taste)
+        cur_item['holiday'] = ', '.join(combined_holiday)
+        if snack.rating is not None:
+            rating = snack.rating.format()
+            cur_item.update(ratings.summary(rating['count'], snack.rating.total))
+            cur_item['rating_histogram'] = rating['histogram']
+        else:
+            cur_item.update(ratings.summary(0, 0))
+            cur_item['rating_histogram'] = [0] * len(ratings.STARS)
+        return cur_item
+
+    return cache.get_or_load(cache.item_key(item_id), load_item,
+                             versions.version_tag(item_versions(item_id)))
@@ -1,12 +1,43 @@
 import os
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 
 SECRET_KEY = os.urandom(32)
 # Grabs the folder where the script runs.
 basedir = os.path.abspath(os.path.dirname(__file__))
 
-# Enable debug mode.
-DEBUG = True
+# Enable debug mode. Off unless asked for: debug mode shows tracebacks
+# to clients (`flask run` with FLASK_DEBUG=True turns it on too)
+DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
+
+# Read API totals from the maintained counters table instead of COUNT(*)
+USE_COUNTER_TABLE = os.getenv('USE_COUNTER_TABLE', 'False').lower() == 'true'
+
+# JSON responses: auto (orjson when installed), orjson or stdlib, see fastjson.py
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'auto')
+
+# Catalog cache: local, memory or redis, see cache.py
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'local')
+CACHE_URL = os.getenv('CACHE_URL')
+
+# ETag / If-None-Match handling on the catalog read endpoints
+ETAGS_ENABLED = os.getenv('ETAGS_ENABLED', 'True').lower() == 'true'
+
+# Item search: auto (postgres on Postgres, else memory), postgres or memory
+SEARCH_BACKEND = os.getenv('SEARCH_BACKEND', 'auto')
+
+# Largest batch accepted by POST /api/v1/items/bulk
+BULK_MAX_ITEMS = int(os.getenv('BULK_MAX_ITEMS', 100000))
+# Largest approve + reject list accepted by POST /admin/comments/moderate
+MODERATION_MAX_IDS = int(os.getenv('MODERATION_MAX_IDS', 50000))
+
+# Background jobs (user signup), see jobs.py
+JOBS_WORKERS = int(os.getenv('JOBS_WORKERS', 4))
+JOBS_QUEUE_SIZE = int(os.getenv('JOBS_QUEUE_SIZE', 100))
+JOBS_TIMEOUT = float(os.getenv('JOBS_TIMEOUT', 10))
+JOBS_RESULT_TTL = int(os.getenv('JOBS_RESULT_TTL', 3600))
+# Signup backend: auth0, or local for the in-memory stand-in, see user.py
+SIGNUP_BACKEND = os.getenv('SIGNUP_BACKEND', 'auth0')
 
 '''
 setup_db(app)
@@ -17,10 +48,76 @@ DB_NAME = os.getenv('DB_NAME', 'fsnd')
 database_path = os.getenv('DATABASE_URL','postgresql://{}/{}'.format(DB_HOST, DB_NAME))
 db = SQLAlchemy()
 
+# Connection pool, per gunicorn worker: a worker holds at most
+# DB_POOL_SIZE + DB_MAX_OVERFLOW connections
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'True').lower() == 'true'
+# Create missing tables at startup, for scratch databases (tests, the
+# benchmark). Off by default: the schema comes from the migrations
+# (python manage.py db upgrade), which would stop on tables create_all()
+# made first, and workers skip the schema introspection queries on boot
+DB_CREATE_ALL = os.getenv('DB_CREATE_ALL', 'False').lower() == 'true'
+# Postgres statement_timeout in milliseconds, 0 turns it off. Applies to
+# the app's connections; manage.py uses MAINTENANCE_STATEMENT_TIMEOUT
+# (default off) and migrations run without one
+DB_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', 30000))
+# Checkouts slower than this (milliseconds) are logged, see instrumentation.py
+DB_POOL_SLOW_CHECKOUT = float(os.getenv('DB_POOL_SLOW_CHECKOUT', 100))
+# Count statements and database time per request (Server-Timing header)
+QUERY_TIMING = os.getenv('QUERY_TIMING', 'False').lower() == 'true'
+
+
+def engine_options(database_path=database_path):
+    '''
+    SQLALCHEMY_ENGINE_OPTIONS for database_path; SQLite keeps its own pool
+    '''
+    if database_path.startswith('sqlite'):
+        return {}
+
+    from instrumentation import InstrumentedQueuePool
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+    }
+    if DB_STATEMENT_TIMEOUT:
+        options['connect_args'] = {
+            'options': '-c statement_timeout={}'.format(DB_STATEMENT_TIMEOUT)}
+    return options
+
+
+## SQLite transactions
+def _sqlite_driver_autocommit(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
+
+
+def _sqlite_begin(connection):
+    connection.exec_driver_sql('BEGIN')
+
+
+def sqlite_savepoints(engine):
+    '''
+    pysqlite starts transactions itself and breaks SAVEPOINT
+    (transaction.savepoint()); let SQLAlchemy emit BEGIN instead
+    '''
+    if not event.contains(engine, 'connect', _sqlite_driver_autocommit):
+        event.listen(engine, 'connect', _sqlite_driver_autocommit)
+        event.listen(engine, 'begin', _sqlite_begin)
+
 
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
-    db.create_all()
+    if database_path.startswith('sqlite'):
+        sqlite_savepoints(db.get_engine(app))
+    if app.config.get('DB_CREATE_ALL', False):
+        db.create_all()
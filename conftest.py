@@ -0,0 +1,64 @@
+'''
+pytest setup: a database per pytest-xdist worker.
+
+test_fsnd.py runs against DB_NAME (fsnd_test, loaded from fsnd.psql).
+With `pytest -n auto` each worker gets its own copy, fsnd_test_gw0,
+fsnd_test_gw1 ..., cloned with CREATE DATABASE ... TEMPLATE when the
+worker starts, so workers never wait on each other's locks. The clones
+are recreated on every run. A SQLite TEST_DATABASE_URL is copied per
+worker the same way.
+
+Every test still rolls back what it wrote (TransactionTestCase), so the
+copies stay identical to the template.
+'''
+import os
+import shutil
+import time
+
+from sqlalchemy import create_engine, exc, text
+
+CLONE_ATTEMPTS = 5
+
+
+def _clone_postgres(worker):
+    host = os.getenv('DB_HOST', 'localhost:5432')
+    template = os.getenv('DB_NAME', 'fsnd_test')
+    name = '{}_{}'.format(template, worker)
+    engine = create_engine('postgresql://{}/postgres'.format(host),
+                           isolation_level='AUTOCOMMIT')
+    try:
+        for attempt in range(CLONE_ATTEMPTS):
+            try:
+                with engine.connect() as connection:
+                    connection.execute(text('DROP DATABASE IF EXISTS {}'.format(name)))
+                    connection.execute(text('CREATE DATABASE {} TEMPLATE {}'.format(
+                        name, template)))
+                break
+            except exc.OperationalError:
+                # the template is busy while another clone or a session is on it
+                if attempt == CLONE_ATTEMPTS - 1:
+                    raise
+                time.sleep(0.2 * (attempt + 1))
+    finally:
+        engine.dispose()
+    os.environ['DB_NAME'] = name
+
+
+def _clone_sqlite(url, worker):
+    path = url[len('sqlite:///'):]
+    clone = '{}.{}'.format(path, worker)
+    shutil.copyfile(path, clone)
+    os.environ['TEST_DATABASE_URL'] = 'sqlite:///' + clone
+
+
+def pytest_configure(config):
+    # runs in every worker before test_fsnd.py is imported
+    worker = os.getenv('PYTEST_XDIST_WORKER')
+    if worker is None:
+        return
+
+    url = os.getenv('TEST_DATABASE_URL')
+    if url and url.startswith('sqlite:///'):
+        _clone_sqlite(url, worker)
+    else:
+        _clone_postgres(worker)
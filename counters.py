@@ -0,0 +1,145 @@
+'''
+Row counts for the totals returned by the API.
+
+By default a total is a SELECT COUNT(*). When USE_COUNTER_TABLE is on,
+totals are read from the counters table instead. The table is updated
+by an after_flush hook on the same connection, so a counter always
+commits or rolls back together with the write that changed it.
+'''
+from collections import defaultdict
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, insert, literal, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from config import db
+from models import Counter, Item, Temp_comment, Comment
+
+TABLE_SCOPE = 0
+
+# counted models and the column holding the item for per-item totals
+COUNTED = {
+    Item: None,
+    Temp_comment: Temp_comment.item,
+    Comment: Comment.item,
+}
+
+
+def counter_table_enabled():
+    return has_app_context() and current_app.config.get('USE_COUNTER_TABLE', False)
+
+
+def _count_statement(model, item=None):
+    statement = select(func.count()).select_from(model.__table__)
+    if item is not None:
+        statement = statement.where(COUNTED[model] == item)
+    return statement
+
+
+def count_rows(model, item=None):
+    '''
+    SELECT COUNT(*) of a table, or of one item's rows
+    '''
+    return db.session.execute(_count_statement(model, item)).scalar()
+
+
+def row_count(model, item=None):
+    '''
+    total rows of model (for one item if given)
+    '''
+    if not counter_table_enabled():
+        return count_rows(model, item)
+
+    value = db.session.query(Counter.value).filter(
+        Counter.name == model.__tablename__,
+        Counter.scope == (TABLE_SCOPE if item is None else item)).scalar()
+
+    if value is None:
+        # nothing was written since the counters were last rebuilt
+        value = count_rows(model, item)
+    return value
+
+
+def adjust(connection, deltas):
+    '''
+    apply {(model, scope): delta} to the counters table
+    call it after the counted rows were written on the same connection
+    '''
+    table = Counter.__table__
+    dialect = {'postgresql': postgresql, 'sqlite': sqlite}.get(connection.dialect.name)
+    for (model, scope), delta in deltas.items():
+        if not delta:
+            continue
+
+        result = connection.execute(
+            update(table)
+            .where(table.c.name == model.__tablename__, table.c.scope == scope)
+            .values(value=table.c.value + delta))
+        if result.rowcount:
+            continue
+
+        # first write since a rebuild, seed it from the table itself
+        item = None if scope == TABLE_SCOPE else scope
+        value = connection.execute(_count_statement(model, item)).scalar()
+        if dialect is None:
+            connection.execute(insert(table).values(
+                name=model.__tablename__, scope=scope, value=value))
+            continue
+        # another first write may have seeded it meanwhile, its count did
+        # not see our rows, so add our delta to it
+        statement = dialect.insert(table).values(
+            name=model.__tablename__, scope=scope, value=value)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.name, table.c.scope],
+            set_={'value': table.c.value + delta}))
+
+
+def _deltas(session):
+    deltas = defaultdict(int)
+    changes = [(obj, 1) for obj in session.new] + [(obj, -1) for obj in session.deleted]
+
+    for obj, step in changes:
+        model = type(obj)
+        if model not in COUNTED:
+            continue
+
+        deltas[(model, TABLE_SCOPE)] += step
+        column = COUNTED[model]
+        if column is not None and getattr(obj, column.key) is not None:
+            deltas[(model, getattr(obj, column.key))] += step
+    return deltas
+
+
+def _after_flush(session, flush_context):
+    if not counter_table_enabled():
+        return
+
+    deltas = _deltas(session)
+    if deltas:
+        adjust(session.connection(), deltas)
+
+
+def rebuild():
+    '''
+    recount every counter from scratch
+    '''
+    table = Counter.__table__
+    db.session.execute(table.delete())
+
+    for model, column in COUNTED.items():
+        db.session.execute(insert(table).values(
+            name=model.__tablename__, scope=TABLE_SCOPE,
+            value=_count_statement(model).scalar_subquery()))
+
+        if column is not None:
+            per_item = select(literal(model.__tablename__), column, func.count()
+                ).where(column.isnot(None)).group_by(column)
+            db.session.execute(insert(table).from_select(
+                ['name', 'scope', 'value'], per_item))
+
+    db.session.commit()
+
+
+def init_app(app):
+    if not event.contains(db.session, 'after_flush', _after_flush):
+        event.listen(db.session, 'after_flush', _after_flush)
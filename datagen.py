@@ -0,0 +1,297 @@
+'''
+Synthetic catalog data at any size, for local performance work.
+
+fsnd.psql has 14 categories, 11 items and a dozen comments, too few to
+show how the queries behave in production. populate() replaces the
+catalog with `items` generated items and everything hanging off them:
+
+- items fall into the fsnd.psql categories with a long tail (a few
+  categories hold most of the items), brands repeat across items
+- each item has 0-3 tastes and 0-2 holidays
+- comments pile up on popular items, about `comments_per_item` per item
+  on average, with ratings leaning towards 4 and 5 stars as real reviews do
+- pending (temp) comments are `pending_ratio` of the published ones
+
+The same items and seed always produce the same rows. Rows go in with
+COPY on Postgres (bulk.copy_rows) and as batched executemany elsewhere,
+then the sequences, counters and ratings are brought in line and every
+version stamp is bumped so no cached response or ETag survives.
+
+usage: python manage.py seed_data --items 1000000 [--seed 1] [--yes]
+
+--yes is required when the catalog already has rows: seeding deletes
+them from whatever DATABASE_URL points to.
+'''
+import random
+from itertools import accumulate
+
+from sqlalchemy import literal, select, text, update
+
+import bulk
+import cache
+import counters
+import ratings
+import versions
+from config import db
+from models import (Category, Item, Taste, Holiday, Comment, Temp_comment,
+                    Counter, ItemRating, Version)
+
+# categories of fsnd.psql, so the ids match the seeded images and templates
+CATEGORIES = ['Chips', 'Cookies', 'Fruits', 'Popcorns', 'Pretzels', 'Cakes',
+              'Candies', 'Chocolates', 'Crackers', 'Jerky', 'Coffee',
+              'Soft Drinks', 'Tea', 'Other']
+TASTES = ['Sweet', 'Salty', 'Spicy', 'Sour', 'Savory', 'Bitter']
+HOLIDAYS = ['Christmas', 'Thanksgiving', 'Halloween', 'Easter',
+            "Valentine's Day", 'New Year']
+FLAVORS = ['Nacho Cheese', 'Sea Salt', 'Barbecue', 'Sour Cream and Onion',
+           'Honey Roasted', 'Dark Chocolate', 'Milk Chocolate', 'Peanut Butter',
+           'Cranberry Orange', 'Caramel', 'Cinnamon', 'Jalapeno', 'Vanilla',
+           'Maple', 'Lemon', 'Original', 'Strawberry', 'Mint', 'Garlic Herb',
+           'Salted Caramel']
+STYLES = ['Baked', 'Crunchy', 'Mini', 'Family Size', 'Organic', 'Reduced Fat',
+          'Kettle Cooked', 'Double Stuffed', 'Classic', 'Gluten Free']
+BRAND_WORDS = (['Golden', 'Sunny', 'Happy', 'Crispy', 'Wild', 'Little', 'Old Mill',
+                'Blue Ridge', 'Red Barn', 'Harbor'],
+               ['Farms', 'Kitchen', 'Snacks', 'Bakery', 'Harvest', 'Foods',
+                'Pantry', 'Orchard', 'Valley', 'Co.'])
+COMMENT_OPENERS = ['An old favorite of mine.', 'Perfect for breakfast on the go.',
+                   'So good, crispy and taste great.', 'Fresh and delicious.',
+                   'Not what I expected.', 'Bought these for a party.',
+                   'My kids love them.', 'A bit too salty for me.',
+                   'Arrived crushed, taste was fine.', 'Would eat it non stop.']
+COMMENT_CLOSERS = ['I keep a bag at all times.', 'Will buy again.',
+                   'Great flavor and crunch.', 'The bag is half air though.',
+                   'Pricey for the size.', 'Goes well with coffee.',
+                   'Would not recommend.', 'Best I have had in years.', '', '']
+# weights of 1 to 5 stars
+RATING_WEIGHTS = [4, 4, 8, 20, 64]
+TASTE_COUNT_WEIGHTS = [20, 45, 25, 10]
+HOLIDAY_COUNT_WEIGHTS = [60, 30, 10]
+# item (and user) popularity: id = 1 + int(n * random() ** skew), higher is steeper
+POPULARITY_SKEW = 2
+CATEGORY_SKEW = 1.1
+ITEMS_PER_BRAND = 20
+GENERATE_CHUNK = 10000
+
+TABLES = [
+    (Category, ('id', 'type')),
+    (Item, ('id', 'title', 'brand', 'category', 'img')),
+    (Taste, ('id', 'taste', 'item')),
+    (Holiday, ('id', 'holiday', 'item')),
+    (Comment, ('id', 'comment', 'rating', 'item', 'userid')),
+    (Temp_comment, ('id', 'comment', 'rating', 'item', 'userid')),
+]
+
+
+def _cumulative(weights):
+    return list(accumulate(weights))
+
+
+def _popular(rng, count, size):
+    '''
+    count ids in 1..size, low ids far more often than high ones
+    '''
+    return [1 + int(size * rng.random() ** POPULARITY_SKEW) for _ in range(count)]
+
+
+def _brands(count):
+    names = ['{} {}'.format(first, second)
+             for first in BRAND_WORDS[0] for second in BRAND_WORDS[1]]
+    return [names[number % len(names)] if number < len(names)
+            else '{} {}'.format(names[number % len(names)], number // len(names) + 1)
+            for number in range(count)]
+
+
+def _chunks(total):
+    for start in range(0, total, GENERATE_CHUNK):
+        yield start, min(GENERATE_CHUNK, total - start)
+
+
+class Generator:
+    '''
+    rows for every catalog table, as tuples in TABLES column order
+
+    each table draws from its own Random, derived from seed, so the rows
+    of one table do not depend on how many rows another one has
+    '''
+    def __init__(self, items, seed=1, comments_per_item=5, pending_ratio=0.05):
+        self.item_count = items
+        self.seed = seed
+        self.comment_count = int(items * comments_per_item)
+        self.pending_count = int(self.comment_count * pending_ratio)
+        self.user_count = max(items // 2, 10)
+        self.brands = _brands(max(items // ITEMS_PER_BRAND, 10))
+
+    def _random(self, table):
+        return random.Random('{}:{}'.format(self.seed, table))
+
+    def categories(self):
+        return [(number, name) for number, name in enumerate(CATEGORIES, 1)]
+
+    def items(self):
+        rng = self._random('items')
+        categories = list(range(1, len(CATEGORIES) + 1))
+        category_weights = _cumulative(1 / rank ** CATEGORY_SKEW for rank in categories)
+        for start, size in _chunks(self.item_count):
+            picked = rng.choices(categories, cum_weights=category_weights, k=size)
+            for offset, category in enumerate(picked):
+                number = start + offset + 1
+                title = '{} {} {}'.format(rng.choice(STYLES), rng.choice(FLAVORS),
+                                          CATEGORIES[category - 1])
+                yield (number, title, rng.choice(self.brands), category,
+                       'snack-cat{}-id{}'.format(category, number))
+
+    def _tags(self, table, names, count_weights):
+        rng = self._random(table)
+        counts = list(range(len(count_weights)))
+        count_weights = _cumulative(count_weights)
+        number = 0
+        for start, size in _chunks(self.item_count):
+            for offset, count in enumerate(rng.choices(counts, cum_weights=count_weights, k=size)):
+                for name in rng.sample(names, count):
+                    number += 1
+                    yield (number, name, start + offset + 1)
+
+    def tastes(self):
+        return self._tags('tastes', TASTES, TASTE_COUNT_WEIGHTS)
+
+    def holidays(self):
+        return self._tags('holidays', HOLIDAYS, HOLIDAY_COUNT_WEIGHTS)
+
+    def _comments(self, table, total):
+        rng = self._random(table)
+        stars = [1.0, 2.0, 3.0, 4.0, 5.0]
+        rating_weights = _cumulative(RATING_WEIGHTS)
+        for start, size in _chunks(total):
+            picked = zip(rng.choices(stars, cum_weights=rating_weights, k=size),
+                         _popular(rng, size, self.item_count),
+                         _popular(rng, size, self.user_count))
+            for offset, (rating, item, user) in enumerate(picked):
+                comment = '{} {}'.format(rng.choice(COMMENT_OPENERS),
+                                         rng.choice(COMMENT_CLOSERS)).strip()
+                yield (start + offset + 1, comment, rating, item, user)
+
+    def comments(self):
+        return self._comments('comments', self.comment_count)
+
+    def temp_comments(self):
+        return self._comments('temp_comments', self.pending_count)
+
+    def tables(self):
+        '''
+        return: [(model, columns, rows)] in load order
+        '''
+        rows = [self.categories(), self.items(), self.tastes(), self.holidays(),
+                self.comments(), self.temp_comments()]
+        return [(model, columns, table_rows)
+                for (model, columns), table_rows in zip(TABLES, rows)]
+
+
+## Loading
+def load_rows(connection, model, columns, rows):
+    '''
+    rows: tuples in columns order; COPY on Postgres, executemany elsewhere
+    return: the number of rows
+    '''
+    if connection.dialect.name == 'postgresql':
+        counted = _Counted(rows)
+        bulk.copy_rows(connection, model.__tablename__, columns, counted)
+        return counted.count
+
+    if connection.dialect.paramstyle == 'qmark':
+        # straight to the driver, skipping the per-row dict handling
+        statement = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            model.__tablename__, ', '.join(columns), ', '.join('?' * len(columns)))
+        execute = lambda chunk: connection.exec_driver_sql(statement, chunk)
+    else:
+        execute = lambda chunk: connection.execute(
+            model.__table__.insert(), [dict(zip(columns, row)) for row in chunk])
+
+    count = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == bulk.BULK_CHUNK_SIZE:
+            execute(chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        execute(chunk)
+        count += len(chunk)
+    return count
+
+
+class _Counted:
+    def __init__(self, rows):
+        self.rows = rows
+        self.count = 0
+
+    def __iter__(self):
+        for row in self.rows:
+            self.count += 1
+            yield row
+
+
+def has_rows(connection):
+    '''
+    return: whether reset() would delete anything from the catalog tables
+    '''
+    return any(connection.execute(select(literal(1)).select_from(model.__table__).limit(1)).first()
+               for model, _ in TABLES)
+
+
+def reset(connection):
+    '''
+    empty the catalog tables and the aggregates derived from them
+    '''
+    tables = [model.__tablename__ for model, _ in TABLES]
+    tables += [Counter.__tablename__, ItemRating.__tablename__]
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text('TRUNCATE {} RESTART IDENTITY'.format(', '.join(tables))))
+    else:
+        for table in tables:
+            connection.execute(text('DELETE FROM {}'.format(table)))
+
+
+def reset_sequences(connection):
+    if connection.dialect.name != 'postgresql':
+        return
+    for model, _ in TABLES:
+        connection.execute(text(
+            "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+            "coalesce(max(id), 1), max(id) IS NOT NULL) FROM {0}".format(model.__tablename__)))
+
+
+def bump_versions(connection):
+    # stamps are never reset, so an ETag from the old data cannot match
+    table = Version.__table__
+    connection.execute(update(table).values(stamp=table.c.stamp + 1))
+    versions.bump(connection, [versions.categories_key(), versions.items_key(),
+                               versions.search_key()]
+                  + [versions.category_key(number) for number in range(1, len(CATEGORIES) + 1)])
+
+
+def populate(items, seed=1, comments_per_item=5, pending_ratio=0.05, progress=None):
+    '''
+    replace the catalog with generated data
+    progress: called with (table, rows) after each table is loaded
+    return: {table: rows loaded}
+    '''
+    generator = Generator(items, seed, comments_per_item, pending_ratio)
+    connection = db.session.connection()
+    reset(connection)
+
+    loaded = {}
+    for model, columns, rows in generator.tables():
+        loaded[model.__tablename__] = load_rows(connection, model, columns, rows)
+        if progress is not None:
+            progress(model.__tablename__, loaded[model.__tablename__])
+
+    reset_sequences(connection)
+    bump_versions(connection)
+    db.session.commit()
+
+    counters.rebuild()
+    ratings.rebuild()
+    cache.catalog_cache.clear()
+    return loaded
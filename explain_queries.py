@@ -0,0 +1,118 @@
+'''
+Print EXPLAIN ANALYZE for the hot queries in app.py before and after the
+lookup indexes (migration c41e7a9d2b58) on a scaled-up copy of the data.
+
+Everything runs in one transaction that is rolled back at the end, so
+the generated rows and the indexes never reach the database.
+
+usage: python explain_queries.py [--items 100000] [--comments-per-item 5]
+needs a Postgres DATABASE_URL (or DB_HOST / DB_NAME), see config.py
+'''
+import argparse
+
+from sqlalchemy import create_engine, text
+
+from config import database_path
+
+INDEXES = [
+    ('ix_items_category', 'items', 'category'),
+    ('ix_tastes_item', 'tastes', 'item'),
+    ('ix_holidays_item', 'holidays', 'item'),
+    ('ix_comments_item_id', 'comments', 'item, id'),
+    ('ix_temp_comments_item_id', 'temp_comments', 'item, id'),
+]
+
+# (description, SQL) as issued by the endpoints; :item and :category are
+# filled with values from the middle of the generated data
+HOT_QUERIES = [
+    ('api_get_item_in_category: items of one category',
+     'SELECT id, title, brand FROM items WHERE category = :category'),
+    ('api_an_item: snack with category, tastes and holidays',
+     'SELECT items.*, categories.type, tastes.taste, holidays.holiday '
+     'FROM items LEFT JOIN categories ON items.category = categories.id '
+     'LEFT JOIN tastes ON items.id = tastes.item '
+     'LEFT JOIN holidays ON items.id = holidays.item '
+     'WHERE items.id = :item'),
+    ('add_comment: total_comments for one item',
+     'SELECT count(*) FROM comments WHERE item = :item'),
+    ('paginate_comments: keyset page',
+     'SELECT * FROM comments WHERE (item, id) > (:item, 0) '
+     'ORDER BY item, id LIMIT 6'),
+    ('paginate_temp_comments: keyset page',
+     'SELECT * FROM temp_comments WHERE (item, id) > (:item, 0) '
+     'ORDER BY item, id LIMIT 6'),
+]
+
+
+def scale_up(connection, items, comments_per_item):
+    connection.execute(text(
+        "WITH c AS (SELECT array_agg(id ORDER BY id) AS ids FROM categories) "
+        "INSERT INTO items (title, brand, category, img) "
+        "SELECT 'Snack ' || n, 'Brand ' || (n % 500), "
+        "c.ids[1 + n % array_length(c.ids, 1)], 'snack' "
+        "FROM c, generate_series(1, :items) AS n"), {'items': items})
+    connection.execute(text(
+        "INSERT INTO tastes (taste, item) "
+        "SELECT (ARRAY['Sweet', 'Salty', 'Spicy', 'Sour'])[1 + n % 4], id "
+        "FROM items, generate_series(1, 2) AS n"))
+    connection.execute(text(
+        "INSERT INTO holidays (holiday, item) "
+        "SELECT (ARRAY['Christmas', 'Thanksgiving', 'Halloween'])[1 + id % 3], id "
+        "FROM items"))
+    for table in ('comments', 'temp_comments'):
+        connection.execute(text(
+            "INSERT INTO {} (comment, rating, item, userid) "
+            "SELECT 'comment ' || n, 1 + (n % 5), id, n "
+            "FROM items, generate_series(1, :per_item) AS n".format(table)),
+            {'per_item': comments_per_item})
+    connection.execute(text("ANALYZE"))
+
+
+def explain(connection, params, title):
+    print('=' * 20, title, '=' * 20)
+    for description, sql in HOT_QUERIES:
+        print('--', description)
+        plan = connection.execute(text('EXPLAIN ANALYZE ' + sql), params)
+        for line, in plan:
+            print('   ', line)
+        print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--comments-per-item', type=int, default=5)
+    parser.add_argument('--database', default=database_path)
+    args = parser.parse_args()
+
+    engine = create_engine(args.database)
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        try:
+            for name, table, columns in INDEXES:
+                connection.execute(text('DROP INDEX IF EXISTS {}'.format(name)))
+
+            scale_up(connection, args.items, args.comments_per_item)
+            params = {
+                'item': connection.execute(text(
+                    'SELECT percentile_disc(0.5) WITHIN GROUP (ORDER BY id) '
+                    'FROM items')).scalar(),
+                'category': connection.execute(text(
+                    'SELECT category FROM items GROUP BY category '
+                    'ORDER BY count(*) DESC LIMIT 1')).scalar(),
+            }
+
+            explain(connection, params, 'before')
+
+            for name, table, columns in INDEXES:
+                connection.execute(text('CREATE INDEX {} ON {} ({})'.format(
+                    name, table, columns)))
+            connection.execute(text('ANALYZE'))
+
+            explain(connection, params, 'after')
+        finally:
+            transaction.rollback()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+'''
+Streaming exports of the catalog and the published comments.
+
+Rows are read over a server-side cursor (stream_results) in batches of
+EXPORT_BATCH_SIZE and written out as they arrive, as NDJSON (one object
+per line) or CSV. Only one batch is held in memory at a time, whatever
+the size of the tables, and the response starts with the first batch.
+'''
+import csv
+import io
+import json
+from collections import defaultdict
+
+from sqlalchemy import select
+
+import ratings
+from config import db
+from models import Category, Item, Taste, Holiday, Comment, ItemRating
+
+EXPORT_BATCH_SIZE = 1000
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+ITEM_FIELDS = ['id', 'title', 'brand', 'category_id', 'category', 'img',
+               'tastes', 'holidays', 'rating', 'reviews']
+COMMENT_FIELDS = ['id', 'item', 'comment', 'rating', 'userid']
+
+
+def _stream(statement):
+    '''
+    yield lists of rows, EXPORT_BATCH_SIZE at a time, from a server-side cursor
+    '''
+    result = db.session.execute(statement.execution_options(
+        stream_results=True, yield_per=EXPORT_BATCH_SIZE))
+    for rows in result.partitions(EXPORT_BATCH_SIZE):
+        yield rows
+
+
+def _tags(model, column, first, last):
+    # the batch holds every item between first and last, a range scan
+    # on the item index picks up all of their tags
+    tags = defaultdict(list)
+    rows = db.session.execute(
+        select(model.item, column).where(model.item.between(first, last))
+        .order_by(model.id))
+    for item_id, value in rows:
+        tags[item_id].append(value)
+    return tags
+
+
+def item_batches():
+    '''
+    yield lists of item dicts in id order, with category, tastes, holidays
+    and rating
+    '''
+    statement = select(
+        Item.id, Item.title, Item.brand, Item.category, Category.type, Item.img,
+        ItemRating.count, ItemRating.total
+        ).outerjoin(Category, Item.category == Category.id
+        ).outerjoin(ItemRating, ItemRating.item == Item.id
+        ).order_by(Item.id)
+
+    for rows in _stream(statement):
+        first, last = rows[0][0], rows[-1][0]
+        tastes = _tags(Taste, Taste.taste, first, last)
+        holidays = _tags(Holiday, Holiday.holiday, first, last)
+
+        batch = []
+        for item_id, title, brand, category_id, category, img, count, total in rows:
+            item = {
+                'id': item_id,
+                'title': title,
+                'brand': brand,
+                'category_id': category_id,
+                'category': category,
+                'img': img,
+                'tastes': tastes[item_id],
+                'holidays': holidays[item_id],
+            }
+            item.update(ratings.summary(count, total))
+            batch.append(item)
+        yield batch
+
+
+def comment_batches():
+    '''
+    yield lists of published comment dicts in id order
+    '''
+    table = Comment.__table__
+    statement = select(*[table.c[field] for field in COMMENT_FIELDS]).order_by(table.c.id)
+    for rows in _stream(statement):
+        yield [dict(zip(COMMENT_FIELDS, row)) for row in rows]
+
+
+def to_ndjson(batches):
+    for batch in batches:
+        yield ''.join(json.dumps(record, sort_keys=True) + '\n' for record in batch)
+
+
+def to_csv(batches, fields):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction='ignore')
+    writer.writeheader()
+    yield buffer.getvalue()
+
+    for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        for record in batch:
+            writer.writerow({field: ', '.join(value) if isinstance(value, list) else value
+                             for field, value in record.items()})
+        yield buffer.getvalue()
+
+
+def render(batches, fields, export_format):
+    '''
+    return: generator of response chunks in export_format
+    '''
+    if export_format == 'csv':
+        return to_csv(batches, fields)
+    return to_ndjson(batches)
@@ -0,0 +1,22 @@
+'''
+gunicorn settings, loaded automatically from the working directory.
+
+Metrics from every worker are merged through PROMETHEUS_MULTIPROC_DIR,
+see metrics.py.
+'''
+import os
+import shutil
+
+
+def on_starting(server):
+    # samples left by a previous run would be merged into the new one
+    path = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+
+def child_exit(server, worker):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,258 @@
+'''
+Connection pool and per-request query instrumentation.
+
+InstrumentedQueuePool (set as the poolclass by config.engine_options)
+times every checkout, including the time spent waiting for a free
+connection. Pool event hooks track the connections in use, new and
+closed connections, invalidations and overflow connections opened past
+pool_size. Everything lands in pool_stats; snapshot() returns the
+current figures for this process.
+
+Checkouts slower than DB_POOL_SLOW_CHECKOUT milliseconds are logged with
+the pool state at the time. If that happens often, the pool is too small
+for the worker's concurrency, or Postgres max_connections is too small
+for workers * (pool_size + max_overflow).
+
+With QUERY_TIMING on, cursor execute hooks count the statements and the
+database time of every request. The totals go out in a Server-Timing
+header and are summed per route in query_stats. Streamed responses
+(exports) query while the body is sent, so they get no Server-Timing and
+their totals are summed when the stream is closed. With it off the hooks
+are never registered, so nothing runs per statement.
+'''
+import logging
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+import metrics
+from config import db
+
+logger = logging.getLogger(__name__)
+
+
+class PoolStats:
+    def __init__(self, slow_checkout=0.1):
+        self.slow_checkout = slow_checkout
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.checkout_seconds = 0.0
+            self.checkout_max = 0.0
+            self.slow_checkouts = 0
+            self.timeouts = 0
+            self.in_use = 0
+            self.in_use_max = 0
+            self.connects = 0
+            self.closes = 0
+            self.invalidations = 0
+            self.overflow_connects = 0
+
+    def record_checkout(self, seconds, pool):
+        with self._lock:
+            self.checkouts += 1
+            self.checkout_seconds += seconds
+            self.checkout_max = max(self.checkout_max, seconds)
+            slow = seconds >= self.slow_checkout
+            if slow:
+                self.slow_checkouts += 1
+        metrics.POOL_CHECKOUT.observe(seconds)
+
+        if slow:
+            logger.warning('slow connection checkout: %.1f ms (%s)',
+                           seconds * 1000, pool.status())
+
+    def record_overflow(self):
+        with self._lock:
+            self.overflow_connects += 1
+        metrics.POOL_EVENTS.labels('overflow').inc()
+
+    def record_timeout(self, pool):
+        with self._lock:
+            self.timeouts += 1
+        metrics.POOL_EVENTS.labels('timeout').inc()
+        logger.warning('connection checkout timed out (%s)', pool.status())
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'checkout_seconds': self.checkout_seconds,
+                'checkout_max_seconds': self.checkout_max,
+                'slow_checkouts': self.slow_checkouts,
+                'timeouts': self.timeouts,
+                'in_use': self.in_use,
+                'in_use_max': self.in_use_max,
+                'connects': self.connects,
+                'closes': self.closes,
+                'invalidations': self.invalidations,
+                'overflow_connects': self.overflow_connects,
+            }
+
+    ## pool events
+    def on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+        metrics.POOL_EVENTS.labels('connect').inc()
+
+    def on_close(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.closes += 1
+        metrics.POOL_EVENTS.labels('close').inc()
+
+    def on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+        metrics.POOL_EVENTS.labels('invalidate').inc()
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.in_use += 1
+            self.in_use_max = max(self.in_use_max, self.in_use)
+        metrics.POOL_IN_USE.inc()
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.in_use = max(self.in_use - 1, 0)
+        metrics.POOL_IN_USE.dec()
+
+
+pool_stats = PoolStats()
+
+POOL_EVENTS = {
+    'connect': pool_stats.on_connect,
+    'close': pool_stats.on_close,
+    'invalidate': pool_stats.on_invalidate,
+    'checkout': pool_stats.on_checkout,
+    'checkin': pool_stats.on_checkin,
+}
+
+
+class InstrumentedQueuePool(QueuePool):
+    '''
+    QueuePool that times checkouts and counts overflow connections
+    '''
+    def _do_get(self):
+        start = time.perf_counter()
+        overflow = self._overflow
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            pool_stats.record_timeout(self)
+            raise
+        if self._overflow > overflow and self._overflow > 0:
+            # opened a connection past pool_size
+            pool_stats.record_overflow()
+        pool_stats.record_checkout(time.perf_counter() - start, self)
+        return connection
+
+
+def instrument_engine(engine):
+    for name, listener in POOL_EVENTS.items():
+        if not event.contains(engine.pool, name, listener):
+            event.listen(engine.pool, name, listener)
+
+
+class QueryStats:
+    '''
+    per route totals: requests, queries, database and request seconds
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes = {}
+
+    def record(self, route, queries, db_seconds, seconds):
+        with self._lock:
+            stats = self.routes.get(route)
+            if stats is None:
+                stats = self.routes[route] = {
+                    'requests': 0, 'queries': 0, 'max_queries': 0,
+                    'db_seconds': 0.0, 'seconds': 0.0}
+            stats['requests'] += 1
+            stats['queries'] += queries
+            stats['max_queries'] = max(stats['max_queries'], queries)
+            stats['db_seconds'] += db_seconds
+            stats['seconds'] += seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {route: dict(stats) for route, stats in self.routes.items()}
+
+    def reset(self):
+        with self._lock:
+            self.routes.clear()
+
+
+query_stats = QueryStats()
+
+
+## cursor hooks, registered only when QUERY_TIMING is on
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # kept on the statement's own context: a statement that fails never
+    # reaches the after hook and takes its start time with it
+    context._query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'query_count' in g:
+        g.query_count += 1
+        g.query_seconds += time.perf_counter() - context._query_start
+
+
+def _start_request():
+    g.query_count = 0
+    g.query_seconds = 0.0
+    g.request_start = time.perf_counter()
+
+
+def _finish_request(response):
+    if 'query_count' not in g:
+        return response
+
+    route = metrics.route_label()
+    name = '{} {}'.format(request.method, route)
+    # the object the statements of a streamed body count into as well,
+    # stream_with_context pushes this request again while it runs
+    timing = g._get_current_object()
+
+    def record():
+        query_stats.record(name, timing.query_count, timing.query_seconds,
+                           time.perf_counter() - timing.request_start)
+        metrics.DB_QUERIES.labels(route).inc(timing.query_count)
+        metrics.DB_SECONDS.labels(route).inc(timing.query_seconds)
+
+    if response.is_streamed:
+        # the body runs its statements after the headers went out: no
+        # Server-Timing, the totals are recorded once the stream is closed
+        response.call_on_close(record)
+        return response
+
+    response.headers.add('Server-Timing', 'db;dur={:.1f};desc="{} queries"'.format(
+        timing.query_seconds * 1000, timing.query_count))
+    response.headers.add('Server-Timing', 'app;dur={:.1f}'.format(
+        (time.perf_counter() - timing.request_start) * 1000))
+    record()
+    return response
+
+
+def instrument_queries(engine):
+    for name, listener in (('before_cursor_execute', _before_cursor_execute),
+                           ('after_cursor_execute', _after_cursor_execute)):
+        if not event.contains(engine, name, listener):
+            event.listen(engine, name, listener)
+
+
+def init_app(app):
+    pool_stats.slow_checkout = app.config.get('DB_POOL_SLOW_CHECKOUT', 100) / 1000.0
+    with app.app_context():
+        instrument_engine(db.engine)
+        if app.config.get('QUERY_TIMING', False):
+            instrument_queries(db.engine)
+            app.before_request(_start_request)
+            app.after_request(_finish_request)
@@ -0,0 +1,131 @@
+'''
+Background jobs on a bounded thread pool.
+
+Work that waits on a slow outside service (the Auth0 signup call) is
+submitted here instead of running inside the request. The endpoint
+answers 202 with the job id and the client polls the job's status.
+
+At most `workers` jobs run at once and at most `queue_size` more wait;
+past that submit() raises JobQueueFull. A job that waited longer than
+`timeout` seconds is dropped as timed_out without running, and a job
+raising TimeoutError is reported as timed_out too, so jobs should bound
+their own calls with the same timeout (see user.py).
+
+Job records are kept in a cache backend (see cache.py) for JOBS_RESULT_TTL
+seconds. With CACHE_BACKEND=redis any gunicorn worker can answer a status
+request for a job that another worker runs.
+'''
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import cache
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+TIMED_OUT = 'timed_out'
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    def __init__(self, workers=4, queue_size=100, timeout=10, store=None):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.store = store if store is not None else cache.LocalBackend()
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        # started on first use, so a gunicorn master that preloads the
+        # app forks before any thread exists
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='jobs')
+            return self._executor
+
+    def submit(self, name, fn, *args, **kwargs):
+        '''
+        return: the queued job record
+        '''
+        if not self._slots.acquire(blocking=False):
+            raise JobQueueFull()
+
+        job = {
+            'id': uuid.uuid4().hex,
+            'name': name,
+            'status': QUEUED,
+            'created': time.time(),
+            'started': None,
+            'finished': None,
+            'result': None,
+            'error': None,
+        }
+        self.store.set(job['id'], job)
+        try:
+            self._pool().submit(self._run, job, fn, args, kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        return job
+
+    def _save(self, job, **changes):
+        job = dict(job, **changes)
+        self.store.set(job['id'], job)
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        try:
+            if time.time() - job['created'] > self.timeout:
+                self._save(job, status=TIMED_OUT, finished=time.time(),
+                           error='waited more than {}s to start'.format(self.timeout))
+                return
+
+            job = self._save(job, status=RUNNING, started=time.time())
+            try:
+                result = fn(*args, **kwargs)
+            except TimeoutError as ex:
+                self._save(job, status=TIMED_OUT, finished=time.time(), error=str(ex))
+            except Exception as ex:
+                self._save(job, status=FAILED, finished=time.time(), error=str(ex))
+            else:
+                self._save(job, status=SUCCEEDED, finished=time.time(), result=result)
+        finally:
+            self._slots.release()
+
+    def get(self, job_id):
+        '''
+        return: the job record, or None for an unknown or expired job
+        '''
+        job = self.store.get(job_id)
+        return None if job is cache.MISSING else job
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+
+signup_jobs = JobQueue()
+
+
+def init_app(app):
+    global signup_jobs
+    signup_jobs.shutdown(wait=False)
+    signup_jobs = JobQueue(
+        workers=app.config.get('JOBS_WORKERS', 4),
+        queue_size=app.config.get('JOBS_QUEUE_SIZE', 100),
+        timeout=app.config.get('JOBS_TIMEOUT', 10),
+        store=cache.make_backend(app.config.get('CACHE_BACKEND', 'local'),
+                                 app.config.get('CACHE_URL'),
+                                 ttl=app.config.get('JOBS_RESULT_TTL', 3600),
+                                 prefix='fsnd:job:'))
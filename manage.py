@@ -1,3 +1,10 @@
+import os
+
+# migrations, seeding and rebuilds run long statements on big tables: the
+# statement_timeout guarding request handlers (config.py) would cancel them.
+# Read before config.py is imported
+os.environ['DB_STATEMENT_TIMEOUT'] = os.getenv('MAINTENANCE_STATEMENT_TIMEOUT', '0')
+
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
@@ -10,5 +17,52 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.command
+def rebuild_counters():
+    """Recount the counters table used when USE_COUNTER_TABLE is on"""
+    import counters
+    counters.rebuild()
+
+
+@manager.command
+def rebuild_ratings():
+    """Recompute the item_ratings aggregates from the comments table"""
+    import ratings
+    ratings.rebuild()
+
+
+@manager.option('-n', '--items', dest='items', type=int, default=1000,
+                help='number of items to generate')
+@manager.option('-s', '--seed', dest='seed', type=int, default=1)
+@manager.option('-c', '--comments-per-item', dest='comments_per_item', type=float,
+                default=5, help='average published comments per item')
+@manager.option('-p', '--pending-ratio', dest='pending_ratio', type=float,
+                default=0.05, help='pending comments per published comment')
+@manager.option('-y', '--yes', dest='yes', action='store_true', default=False,
+                help='empty the catalog even when it already has rows')
+def seed_data(items, seed, comments_per_item, pending_ratio, yes):
+    """Replace the catalog with generated data (see datagen.py)"""
+    import sys
+    import time
+    import datagen
+    from config import db
+
+    if not yes and datagen.has_rows(db.session.connection()):
+        print('the catalog of {!r} is not empty and seed_data deletes it; '
+              'rerun with --yes to go ahead'.format(db.engine.url))
+        sys.exit(1)
+
+    started = time.perf_counter()
+
+    def progress(table, rows):
+        print('{:<14} {:>10} rows  {:7.1f}s'.format(
+            table, rows, time.perf_counter() - started))
+
+    loaded = datagen.populate(items, seed, comments_per_item, pending_ratio, progress)
+    seconds = time.perf_counter() - started
+    print('{} rows in {:.1f}s, {:.0f} rows/minute'.format(
+        sum(loaded.values()), seconds, sum(loaded.values()) / seconds * 60))
+
+
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
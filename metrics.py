@@ -0,0 +1,118 @@
+'''
+Prometheus metrics, served at /metrics.
+
+init_app() adds request hooks that record, per URL rule, a latency
+histogram, a request counter by status and an in-flight gauge. auth.py,
+cache.py and instrumentation.py count token checks, cache lookups, pool
+activity and (with QUERY_TIMING on) statements through the metrics below.
+
+Under gunicorn each worker is its own process. Set
+PROMETHEUS_MULTIPROC_DIR to an empty directory before the workers start:
+every process then writes its samples to files there and /metrics
+merges them, whichever worker answers. gunicorn.conf.py clears the
+directory at startup and drops the files of workers that exit.
+'''
+import os
+import time
+
+from flask import g, request
+from prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram,
+                               CONTENT_TYPE_LATEST, REGISTRY, generate_latest)
+from prometheus_client import multiprocess
+
+
+def _multiprocess():
+    return bool(os.getenv('PROMETHEUS_MULTIPROC_DIR'))
+
+
+## HTTP
+REQUESTS = Counter(
+    'fsnd_http_requests_total', 'HTTP requests by route and status',
+    ['method', 'route', 'status'])
+LATENCY = Histogram(
+    'fsnd_http_request_duration_seconds', 'Time to build the response',
+    ['method', 'route'])
+IN_FLIGHT = Gauge(
+    'fsnd_http_requests_in_flight', 'Requests being handled',
+    ['method', 'route'], multiprocess_mode='livesum')
+
+## auth
+AUTH_CHECKS = Counter(
+    'fsnd_auth_checks_total',
+    'Bearer token checks: cached, verified, rejected or forbidden',
+    ['result'])
+
+## cache
+CACHE_LOOKUPS = Counter(
+    'fsnd_cache_lookups_total', 'Catalog cache lookups', ['result'])
+CACHE_INVALIDATIONS = Counter(
+    'fsnd_cache_invalidations_total', 'Catalog cache keys dropped')
+
+## database
+DB_QUERIES = Counter(
+    'fsnd_db_queries_total', 'SQL statements, counted when QUERY_TIMING is on',
+    ['route'])
+DB_SECONDS = Counter(
+    'fsnd_db_query_seconds_total', 'Time spent in SQL statements, when QUERY_TIMING is on',
+    ['route'])
+POOL_CHECKOUT = Histogram(
+    'fsnd_db_pool_checkout_seconds', 'Time to get a connection from the pool',
+    buckets=(.0005, .001, .005, .01, .025, .05, .1, .25, .5, 1, 5, 30))
+POOL_IN_USE = Gauge(
+    'fsnd_db_pool_connections_in_use', 'Connections checked out of the pool',
+    multiprocess_mode='livesum')
+POOL_EVENTS = Counter(
+    'fsnd_db_pool_events_total',
+    'Pool events: connect, close, invalidate, overflow, timeout',
+    ['event'])
+
+
+def route_label():
+    # the URL rule, not the path, keeps the number of series bounded
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def _start_request():
+    g.metrics_labels = (request.method, route_label())
+    g.metrics_start = time.perf_counter()
+    IN_FLIGHT.labels(*g.metrics_labels).inc()
+
+
+def _record_response(response):
+    if 'metrics_start' in g:
+        LATENCY.labels(*g.metrics_labels).observe(time.perf_counter() - g.metrics_start)
+        REQUESTS.labels(*g.metrics_labels, str(response.status_code)).inc()
+    return response
+
+
+def _finish_request(exception):
+    if 'metrics_start' in g:
+        IN_FLIGHT.labels(*g.metrics_labels).dec()
+
+
+def render():
+    '''
+    return: (body, content type) of the current metrics
+    '''
+    if _multiprocess():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def init_app(app):
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+
+    # ahead of the other before_request hooks (CSRF), so requests they
+    # reject are still counted
+    app.before_request_funcs.setdefault(None, []).insert(0, _start_request)
+    app.after_request(_record_response)
+    app.teardown_request(_finish_request)
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        body, content_type = render()
+        return app.response_class(body, content_type=content_type)
@@ -73,6 +73,9 @@ def run_migrations_online():
     connectable = current_app.extensions['migrate'].db.engine
 
     with connectable.connect() as connection:
+        if connection.dialect.name == 'postgresql':
+            # index builds and backfills outlast the request statement_timeout
+            connection.exec_driver_sql('SET statement_timeout = 0')
         context.configure(
             connection=connection,
             target_metadata=target_metadata,
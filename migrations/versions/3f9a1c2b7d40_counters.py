@@ -0,0 +1,29 @@
+"""counters table for maintained row counts
+
+Revision ID: 3f9a1c2b7d40
+Revises: e05cf44003d7
+Create Date: 2026-10-18 10:12:31.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9a1c2b7d40'
+down_revision = 'e05cf44003d7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('counters',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('scope', sa.Integer(), nullable=False),
+    sa.Column('value', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('name', 'scope')
+    )
+
+
+def downgrade():
+    op.drop_table('counters')
@@ -0,0 +1,124 @@
+"""full-text and trigram search columns on items
+
+Revision ID: 5d0f3b8e6c21
+Revises: c41e7a9d2b58
+Create Date: 2026-10-18 12:26:44.071958
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '5d0f3b8e6c21'
+down_revision = 'c41e7a9d2b58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.add_column('items', sa.Column('search_text', sa.Text(), nullable=True))
+    op.add_column('items', sa.Column('search_vector', postgresql.TSVECTOR(), nullable=True))
+
+    # rebuilds the search columns of an item from its row, category,
+    # tastes and holidays; weights match the ones in search.py
+    op.execute("""
+        CREATE FUNCTION items_search_document() RETURNS trigger AS $$
+        DECLARE
+            category_type text;
+            tags text;
+        BEGIN
+            SELECT type INTO category_type FROM categories WHERE id = NEW.category;
+            SELECT concat_ws(' ',
+                (SELECT string_agg(taste, ' ') FROM tastes WHERE item = NEW.id),
+                (SELECT string_agg(holiday, ' ') FROM holidays WHERE item = NEW.id))
+                INTO tags;
+
+            NEW.search_text := lower(concat_ws(' ', NEW.title, NEW.brand, category_type, tags));
+            NEW.search_vector :=
+                setweight(to_tsvector('english', concat_ws(' ', NEW.title, NEW.brand)), 'A') ||
+                setweight(to_tsvector('english', coalesce(category_type, '')), 'B') ||
+                setweight(to_tsvector('english', coalesce(tags, '')), 'C');
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER items_search_document
+        BEFORE INSERT OR UPDATE OF title, brand, category ON items
+        FOR EACH ROW EXECUTE PROCEDURE items_search_document()
+    """)
+
+    # tastes, holidays and categories touch the items they belong to,
+    # which reruns the trigger above; statement level so bulk loads touch
+    # every item once
+    op.execute("""
+        CREATE FUNCTION items_search_touch() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                UPDATE items SET title = title WHERE id IN (SELECT item FROM old_rows);
+            ELSE
+                UPDATE items SET title = title WHERE id IN (SELECT item FROM new_rows);
+            END IF;
+            IF TG_OP = 'UPDATE' THEN
+                UPDATE items SET title = title WHERE id IN (SELECT item FROM old_rows);
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    for table in ('tastes', 'holidays'):
+        op.execute("""
+            CREATE TRIGGER {0}_search_insert AFTER INSERT ON {0}
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE PROCEDURE items_search_touch()
+        """.format(table))
+        op.execute("""
+            CREATE TRIGGER {0}_search_update AFTER UPDATE ON {0}
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE PROCEDURE items_search_touch()
+        """.format(table))
+        op.execute("""
+            CREATE TRIGGER {0}_search_delete AFTER DELETE ON {0}
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE PROCEDURE items_search_touch()
+        """.format(table))
+
+    op.execute("""
+        CREATE FUNCTION categories_search_touch() RETURNS trigger AS $$
+        BEGIN
+            UPDATE items SET title = title WHERE category = NEW.id;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER categories_search_touch
+        AFTER UPDATE OF type ON categories
+        FOR EACH ROW EXECUTE PROCEDURE categories_search_touch()
+    """)
+
+    # backfill, then index
+    op.execute('UPDATE items SET title = title')
+    op.create_index('ix_items_search_vector', 'items', ['search_vector'],
+                    postgresql_using='gin')
+    op.create_index('ix_items_search_text_trgm', 'items', ['search_text'],
+                    postgresql_using='gin',
+                    postgresql_ops={'search_text': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_items_search_text_trgm', table_name='items')
+    op.drop_index('ix_items_search_vector', table_name='items')
+    op.execute('DROP TRIGGER categories_search_touch ON categories')
+    op.execute('DROP FUNCTION categories_search_touch()')
+    for table in ('tastes', 'holidays'):
+        for event in ('insert', 'update', 'delete'):
+            op.execute('DROP TRIGGER {0}_search_{1} ON {0}'.format(table, event))
+    op.execute('DROP FUNCTION items_search_touch()')
+    op.execute('DROP TRIGGER items_search_document ON items')
+    op.execute('DROP FUNCTION items_search_document()')
+    op.drop_column('items', 'search_vector')
+    op.drop_column('items', 'search_text')
@@ -0,0 +1,49 @@
+"""item_ratings table for per-item rating aggregates
+
+Revision ID: 7a4c2e9f0b15
+Revises: 5d0f3b8e6c21
+Create Date: 2026-10-18 13:05:12.448310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a4c2e9f0b15'
+down_revision = '5d0f3b8e6c21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('item_ratings',
+    sa.Column('item', sa.Integer(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.Column('total', sa.Float(), nullable=False),
+    sa.Column('stars_1', sa.Integer(), nullable=False),
+    sa.Column('stars_2', sa.Integer(), nullable=False),
+    sa.Column('stars_3', sa.Integer(), nullable=False),
+    sa.Column('stars_4', sa.Integer(), nullable=False),
+    sa.Column('stars_5', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('item')
+    )
+
+    # backfill from the published comments, same buckets as ratings.stars()
+    op.execute("""
+        INSERT INTO item_ratings
+            (item, count, total, stars_1, stars_2, stars_3, stars_4, stars_5)
+        SELECT item, count(*), sum(rating),
+            count(*) FILTER (WHERE floor(rating + 0.5) <= 1),
+            count(*) FILTER (WHERE floor(rating + 0.5) = 2),
+            count(*) FILTER (WHERE floor(rating + 0.5) = 3),
+            count(*) FILTER (WHERE floor(rating + 0.5) = 4),
+            count(*) FILTER (WHERE floor(rating + 0.5) >= 5)
+        FROM comments
+        WHERE item IS NOT NULL AND rating IS NOT NULL
+        GROUP BY item
+    """)
+
+
+def downgrade():
+    op.drop_table('item_ratings')
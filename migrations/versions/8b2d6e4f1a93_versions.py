@@ -0,0 +1,29 @@
+"""versions table for ETag stamps
+
+Revision ID: 8b2d6e4f1a93
+Revises: 3f9a1c2b7d40
+Create Date: 2026-10-18 11:02:47.918236
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b2d6e4f1a93'
+down_revision = '3f9a1c2b7d40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('versions',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('scope', sa.Integer(), nullable=False),
+    sa.Column('stamp', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('name', 'scope')
+    )
+
+
+def downgrade():
+    op.drop_table('versions')
@@ -0,0 +1,40 @@
+"""indexes on the lookup columns
+
+Revision ID: c41e7a9d2b58
+Revises: 8b2d6e4f1a93
+Create Date: 2026-10-18 11:40:05.337120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41e7a9d2b58'
+down_revision = '8b2d6e4f1a93'
+branch_labels = None
+depends_on = None
+
+# (item, id) also serves plain lookups on item, so comments get no
+# separate single column index
+INDEXES = [
+    ('ix_items_category', 'items', ['category']),
+    ('ix_tastes_item', 'tastes', ['item']),
+    ('ix_holidays_item', 'holidays', ['item']),
+    ('ix_comments_item_id', 'comments', ['item', 'id']),
+    ('ix_temp_comments_item_id', 'temp_comments', ['item', 'id']),
+]
+
+
+def upgrade():
+    # build without blocking writes; CONCURRENTLY cannot run in a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, unique=False,
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
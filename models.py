@@ -1,11 +1,14 @@
 import os
-from sqlalchemy import Float, Column, String, Integer, create_engine
+from sqlalchemy import Float, Column, String, Integer, BigInteger, Index, create_engine
+from sqlalchemy.orm import relationship
 from flask_sqlalchemy import SQLAlchemy
 import json
 from config import db
+import transaction
 
 def commit_session():
-    db.session.commit()
+    # requests commit on their own, see transaction.py
+    transaction.commit()
 
 """
 Category
@@ -32,9 +35,23 @@ class Item(db.Model):
     id = Column(Integer, primary_key=True)
     title = Column(String)
     brand = Column(String)
-    category = Column(Integer)
+    category = Column(Integer, index=True)
     img = Column(String)
 
+    # read-only links for eager loading, the tables have no FK constraints
+    category_record = relationship(
+        'Category', primaryjoin='foreign(Item.category) == Category.id',
+        viewonly=True)
+    tastes = relationship(
+        'Taste', primaryjoin='Item.id == foreign(Taste.item)',
+        order_by='Taste.id', viewonly=True)
+    holidays = relationship(
+        'Holiday', primaryjoin='Item.id == foreign(Holiday.item)',
+        order_by='Holiday.id', viewonly=True)
+    rating = relationship(
+        'ItemRating', primaryjoin='Item.id == foreign(ItemRating.item)',
+        uselist=False, viewonly=True)
+
     def __init__(self, title, brand, category, img):
         self.title = title
         self.brand = brand
@@ -43,14 +60,14 @@ class Item(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
 
     def update(self):
-        db.session.commit()
+        db.session.flush()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        db.session.flush()
 
     def format(self):
         return {
@@ -63,6 +80,7 @@ class Item(db.Model):
 
 class Temp_comment(db.Model):
     __tablename__ = 'temp_comments'
+    __table_args__ = (Index('ix_temp_comments_item_id', 'item', 'id'),)
 
     id = Column(Integer, primary_key=True)
     comment = Column(String)
@@ -78,14 +96,14 @@ class Temp_comment(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
 
     def update(self):
-        db.session.commit()
+        db.session.flush()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        db.session.flush()
 
     def format(self):
         return {
@@ -98,6 +116,7 @@ class Temp_comment(db.Model):
 
 class Comment(db.Model):
     __tablename__ = 'comments'
+    __table_args__ = (Index('ix_comments_item_id', 'item', 'id'),)
 
     id = Column(Integer, primary_key=True)
     comment = Column(String)
@@ -113,14 +132,14 @@ class Comment(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
 
     def update(self):
-        db.session.commit()
+        db.session.flush()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        db.session.flush()
         
     def format(self):
         return {
@@ -137,7 +156,7 @@ class Taste(db.Model):
 
     id = Column(Integer, primary_key=True)
     taste = Column(String)
-    item = Column(Integer)
+    item = Column(Integer, index=True)
 
     def __init__(self, taste, item):
         self.taste = taste
@@ -145,14 +164,14 @@ class Taste(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
 
     def update(self):
-        db.session.commit()
+        db.session.flush()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        db.session.flush()
         
     def format(self):
         return {
@@ -166,7 +185,7 @@ class Holiday(db.Model):
 
     id = Column(Integer, primary_key=True)
     holiday = Column(String)
-    item = Column(Integer)
+    item = Column(Integer, index=True)
     
     def __init__(self, holiday, item):
         self.holiday = holiday
@@ -174,18 +193,87 @@ class Holiday(db.Model):
         
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
 
     def update(self):
-        db.session.commit()
+        db.session.flush()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        db.session.flush()
         
     def format(self):
         return {
             'id': self.id,
             'holiday': self.holiday,
             'item': self.item
-            }
\ No newline at end of file
+            }
+
+"""
+Counter
+
+maintained row counts, see counters.py
+scope is 0 for a whole table, otherwise the item id
+"""
+class Counter(db.Model):
+    __tablename__ = 'counters'
+
+    name = Column(String, primary_key=True)
+    scope = Column(Integer, primary_key=True, default=0)
+    value = Column(BigInteger, nullable=False, default=0)
+
+    def format(self):
+        return {
+            'name': self.name,
+            'scope': self.scope,
+            'value': self.value
+            }
+
+
+"""
+Version
+
+change stamps behind the ETags, see versions.py
+scope is 0 for a whole table, otherwise the category or item id
+"""
+class Version(db.Model):
+    __tablename__ = 'versions'
+
+    name = Column(String, primary_key=True)
+    scope = Column(Integer, primary_key=True, default=0)
+    stamp = Column(BigInteger, nullable=False, default=0)
+
+    def format(self):
+        return {
+            'name': self.name,
+            'scope': self.scope,
+            'stamp': self.stamp
+            }
+
+
+"""
+ItemRating
+
+running rating aggregate of an item's published comments, see ratings.py
+stars_1 ... stars_5 count the ratings rounded to whole stars
+"""
+class ItemRating(db.Model):
+    __tablename__ = 'item_ratings'
+
+    item = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    total = Column(Float, nullable=False, default=0)
+    stars_1 = Column(Integer, nullable=False, default=0)
+    stars_2 = Column(Integer, nullable=False, default=0)
+    stars_3 = Column(Integer, nullable=False, default=0)
+    stars_4 = Column(Integer, nullable=False, default=0)
+    stars_5 = Column(Integer, nullable=False, default=0)
+
+    def format(self):
+        return {
+            'item': self.item,
+            'count': self.count,
+            'average': round(self.total / self.count, 2) if self.count else None,
+            'histogram': [self.stars_1, self.stars_2, self.stars_3,
+                          self.stars_4, self.stars_5]
+            }
@@ -1,26 +1,86 @@
+import base64
+import json
+import os
+
+from flask import abort
+from sqlalchemy import tuple_
+
 from models import commit_session, Category, Item, Temp_comment, Comment
 
 ITEMS_PER_PAGE = 10
 TEMP_COMMENTS_PER_PAGE = 5
 COMMENTS_PER_PAGE = 5
+# upper bound for ?per_page=
+MAX_PER_PAGE = int(os.getenv('MAX_PER_PAGE', 100))
+
+'''
+Two ways to page through a table:
+
+?page=n     LIMIT/OFFSET, ordered by id (the original behaviour)
+?cursor=c   keyset pagination: rows after the key encoded in c, using the
+            next_cursor of the previous page. An empty cursor starts at
+            the first row. Every page costs the same no matter how deep.
+
+Both accept ?per_page=, capped at MAX_PER_PAGE. Each paginate_* function
+returns (records, next_cursor); next_cursor is None in page mode and on
+the last page.
+'''
+
+def encode_cursor(values):
+    raw = json.dumps(list(values), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, size):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except ValueError:
+        abort(400)
+
+    if (not isinstance(values, list) or len(values) != size
+            or not all(type(value) is int for value in values)):
+        abort(400)
+    return values
+
+def get_page_size(request, default):
+    per_page = request.args.get("per_page", default, type=int)
+    return max(1, min(per_page, MAX_PER_PAGE))
+
+def paginate(request, query, key_columns, per_page):
+    size = get_page_size(request, per_page)
+
+    if "cursor" not in request.args:
+        page = request.args.get("page", 1, type=int)
+        current_index = page - 1
+        records = query.order_by(key_columns[-1]).limit(
+            size).offset(current_index * size).all()
+        return [record.format() for record in records], None
+
+    query = query.order_by(*key_columns)
+    cursor = request.args["cursor"]
+    if cursor:
+        after = decode_cursor(cursor, len(key_columns))
+        if len(key_columns) == 1:
+            query = query.filter(key_columns[0] > after[0])
+        else:
+            query = query.filter(tuple_(*key_columns) > tuple_(*after))
+
+    # one extra row tells us whether there is a next page
+    records = query.limit(size + 1).all()
+    next_cursor = None
+    if len(records) > size:
+        records = records[:size]
+        next_cursor = encode_cursor(
+            getattr(records[-1], column.key) for column in key_columns)
+    return [record.format() for record in records], next_cursor
 
 def paginate_items(request):
-    page = request.args.get("page", 1, type=int)
-    current_index = page - 1
-    items = Item.query.order_by(Item.id).limit(
-        ITEMS_PER_PAGE).offset(current_index * ITEMS_PER_PAGE).all()
-    return [item.format() for item in items]
+    return paginate(request, Item.query, [Item.id], ITEMS_PER_PAGE)
 
 def paginate_temp_comments(request):
-    page = request.args.get("page", 1, type=int)
-    current_index = page - 1
-    comments = Temp_comment.query.order_by(Temp_comment.id).limit(
-        TEMP_COMMENTS_PER_PAGE).offset(current_index * TEMP_COMMENTS_PER_PAGE).all()
-    return [comment.format() for comment in comments]
+    return paginate(request, Temp_comment.query,
+                    [Temp_comment.item, Temp_comment.id], TEMP_COMMENTS_PER_PAGE)
 
 def paginate_comments(request):
-    page = request.args.get("page", 1, type=int)
-    current_index = page - 1
-    comments = Comment.query.order_by(Comment.id).limit(
-        COMMENTS_PER_PAGE).offset(current_index * COMMENTS_PER_PAGE).all()
-    return [comment.format() for comment in comments]
\ No newline at end of file
+    return paginate(request, Comment.query,
+                    [Comment.item, Comment.id], COMMENTS_PER_PAGE)
@@ -0,0 +1,179 @@
+'''
+Per-item rating aggregates for published comments.
+
+item_ratings keeps the number of rated comments, the sum of their
+ratings and a five-bucket histogram for every item. An after_flush hook
+applies the changes of a flush on the same connection, so the aggregate
+commits or rolls back together with the comments; bulk writes call
+apply() themselves. The catalog reads join the table, so a listing gets
+its ratings without touching comments.
+
+The table is filled from the comments when it is created, by migration
+7a4c2e9f0b15 or by create_all(); `python manage.py rebuild_ratings`
+recomputes it.
+'''
+from collections import defaultdict
+
+from sqlalchemy import case, event, func, inspect, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+import cache
+from config import db
+from models import ItemRating, Item, Comment
+
+STARS = (1, 2, 3, 4, 5)
+
+
+def stars(rating):
+    '''
+    histogram bucket of a rating, None for an unrated comment
+    '''
+    if rating is None:
+        return None
+    return min(max(int(rating + 0.5), 1), 5)
+
+
+def summary(count, total):
+    '''
+    return: {rating: average or None, reviews: count} as shown in listings
+    '''
+    count = count or 0
+    return {'rating': round(total / count, 2) if count else None, 'reviews': count}
+
+
+class Deltas:
+    '''
+    per-item changes to apply to item_ratings
+    '''
+    def __init__(self):
+        self.items = defaultdict(lambda: {'count': 0, 'total': 0.0, 'stars': defaultdict(int)})
+
+    def add(self, item, rating, step):
+        if item is None or rating is None:
+            return
+        delta = self.items[item]
+        delta['count'] += step
+        delta['total'] += step * rating
+        delta['stars'][stars(rating)] += step
+
+    def __bool__(self):
+        return bool(self.items)
+
+
+def apply(connection, deltas):
+    '''
+    add deltas to item_ratings, creating missing rows
+    '''
+    table = ItemRating.__table__
+    rows = []
+    # a fixed order keeps concurrent writers from deadlocking
+    for item in sorted(deltas.items):
+        delta = deltas.items[item]
+        row = {'item': item, 'count': delta['count'], 'total': delta['total']}
+        for star in STARS:
+            row['stars_{}'.format(star)] = delta['stars'][star]
+        if any(row[column] for column in row if column != 'item'):
+            rows.append(row)
+    if not rows:
+        return
+
+    columns = ['count', 'total'] + ['stars_{}'.format(star) for star in STARS]
+    dialect = {'postgresql': postgresql, 'sqlite': sqlite}.get(connection.dialect.name)
+    if dialect is not None:
+        statement = dialect.insert(table)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.item],
+            set_={column: table.c[column] + statement.excluded[column]
+                  for column in columns}), rows)
+        return
+
+    for row in rows:
+        result = connection.execute(
+            update(table).where(table.c.item == row['item'])
+            .values({column: table.c[column] + row[column] for column in columns}))
+        if result.rowcount == 0:
+            connection.execute(insert(table).values(row))
+
+
+def _deltas(session):
+    deltas = Deltas()
+    for obj in session.new:
+        if isinstance(obj, Comment):
+            deltas.add(obj.item, obj.rating, 1)
+    for obj in session.deleted:
+        if isinstance(obj, Comment):
+            deltas.add(obj.item, obj.rating, -1)
+
+    for obj in session.dirty:
+        if not isinstance(obj, Comment):
+            continue
+        attrs = inspect(obj).attrs
+        if not (attrs.rating.history.has_changes() or attrs.item.history.has_changes()):
+            continue
+        old_rating = (attrs.rating.history.deleted or [obj.rating])[0]
+        old_item = (attrs.item.history.deleted or [obj.item])[0]
+        deltas.add(old_item, old_rating, -1)
+        deltas.add(obj.item, obj.rating, 1)
+    return deltas
+
+
+def _after_flush(session, flush_context):
+    deltas = _deltas(session)
+    if deltas:
+        apply(session.connection(), deltas)
+        # the rows changed under the ORM: loaded copies reload on next access
+        for (model, identity, _), obj in list(session.identity_map.items()):
+            if model is ItemRating and identity[0] in deltas.items:
+                session.expire(obj)
+
+
+def _fill_statement():
+    table = ItemRating.__table__
+    rating = Comment.__table__.c.rating
+    bucket = func.floor(rating + 0.5)
+    bucket = case((bucket < 1, 1), (bucket > 5, 5), else_=bucket)
+    histogram = [func.sum(case((bucket == star, 1), else_=0)) for star in STARS]
+
+    per_item = select(Comment.item, func.count(rating), func.sum(rating), *histogram
+        ).where(Comment.item.isnot(None), rating.isnot(None)).group_by(Comment.item)
+    return insert(table).from_select(
+        ['item', 'count', 'total'] + ['stars_{}'.format(star) for star in STARS],
+        per_item)
+
+
+def rebuild():
+    '''
+    recompute every aggregate from comments
+    '''
+    db.session.execute(ItemRating.__table__.delete())
+    db.session.execute(_fill_statement())
+    db.session.commit()
+
+
+def _after_create(table, connection, **kw):
+    # create_all() made item_ratings on a database that already has
+    # comments (fsnd.psql without `db upgrade`): fill it as the migration does
+    if inspect(connection).has_table(Comment.__tablename__):
+        connection.execute(_fill_statement())
+
+
+# registered at import, create_all() runs in setup_db() before init_app()
+event.listen(ItemRating.__table__, 'after_create', _after_create)
+
+
+def invalidate(item_ids):
+    '''
+    drop the cached entries that show the ratings of item_ids
+    '''
+    item_ids = [item_id for item_id in item_ids if item_id is not None]
+    if not item_ids:
+        return
+    categories = db.session.execute(
+        select(Item.category).where(Item.id.in_(item_ids)).distinct()).scalars().all()
+    cache.invalidate_item(*item_ids)
+    cache.invalidate_category(*categories)
+
+
+def init_app(app):
+    if not event.contains(db.session, 'after_flush', _after_flush):
+        event.listen(db.session, 'after_flush', _after_flush)
@@ -0,0 +1,263 @@
+'''
+Ranked item search over title, brand, category, tastes and holidays.
+
+On Postgres the search runs in the database. Migration 5d0f3b8e6c21
+adds items.search_vector (tsvector) and items.search_text (plain text),
+kept up to date by triggers. Both have GIN indexes, the text column
+with trigram ops for typo tolerance.
+
+Elsewhere (SQLite, tests) an in-memory InvertedIndex is built from the
+tables and rebuilt whenever the search version stamp changes.
+SEARCH_BACKEND in config.py forces one or the other. A Postgres database
+without the migration's columns (fsnd.psql loaded, `db upgrade` not run
+yet) gets the in-memory search too, with a warning in the log.
+
+The search stamp is a single row for the whole index, so it is only
+bumped while the in-memory search is in use, and only by writes to the
+fields the index is built from. On Postgres with the search columns,
+item writes do not queue on it.
+'''
+import logging
+import math
+import re
+import threading
+from collections import defaultdict
+
+from flask import current_app
+from sqlalchemy import event, inspect, text
+
+import versions
+from config import db
+from models import Category, Item, Taste, Holiday
+
+# field weights, mirroring setweight() A/B/C in the migration
+TITLE_WEIGHT = 3.0
+CATEGORY_WEIGHT = 2.0
+TAG_WEIGHT = 1.0
+# minimum trigram similarity for a misspelled word to match
+TRIGRAM_THRESHOLD = 0.4
+SEARCH_COLUMNS = {'search_vector', 'search_text'}
+# the columns build_index() reads, per model
+INDEXED_FIELDS = {
+    Item: ('title', 'brand', 'category', 'img'),
+    Category: ('type',),
+    Taste: ('taste', 'item'),
+    Holiday: ('holiday', 'item'),
+}
+
+logger = logging.getLogger(__name__)
+
+_word = re.compile(r'[a-z0-9]+')
+
+
+def stem(word):
+    # plural folding, enough for snack names
+    if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+        return word[:-1]
+    return word
+
+
+def tokenize(value):
+    return [stem(word) for word in _word.findall((value or '').lower())]
+
+
+def trigrams(word):
+    padded = '  {} '.format(word)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def item_payload(item_id, title, brand, category, img):
+    return {
+        'id': item_id,
+        'title': title,
+        'brand': brand,
+        'category': category,
+        'img': img
+        }
+
+
+class InvertedIndex:
+    '''
+    token -> {item id: weight} postings plus a trigram -> tokens map,
+    scored with tf-idf; words that are not in the vocabulary fall back to
+    the closest words by trigram similarity
+    '''
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.trigram_tokens = defaultdict(set)
+        self.items = {}
+
+    def add(self, item, fields):
+        '''
+        item: payload returned for hits
+        fields: [(text, weight)]
+        '''
+        self.items[item['id']] = item
+        for value, weight in fields:
+            for token in tokenize(value):
+                postings = self.postings[token]
+                if not postings:
+                    for trigram in trigrams(token):
+                        self.trigram_tokens[trigram].add(token)
+                postings[item['id']] = postings.get(item['id'], 0) + weight
+
+    def _expand(self, token):
+        if token in self.postings:
+            return [(token, 1.0)]
+
+        wanted = trigrams(token)
+        candidates = set()
+        for trigram in wanted:
+            candidates |= self.trigram_tokens.get(trigram, set())
+
+        matches = []
+        for candidate in candidates:
+            theirs = trigrams(candidate)
+            similarity = len(wanted & theirs) / len(wanted | theirs)
+            if similarity >= TRIGRAM_THRESHOLD:
+                matches.append((candidate, similarity))
+        return matches
+
+    def search(self, term, offset=0, limit=10):
+        '''
+        return: list of (item payload, score), best first
+        '''
+        scores = defaultdict(float)
+        for token in set(tokenize(term)):
+            for match, similarity in self._expand(token):
+                postings = self.postings[match]
+                idf = math.log(1 + len(self.items) / len(postings))
+                for item_id, weight in postings.items():
+                    scores[item_id] += weight * idf * similarity
+
+        ranked = sorted(scores.items(), key=lambda hit: (-hit[1], hit[0]))
+        return [(self.items[item_id], score)
+                for item_id, score in ranked[offset:offset + limit]]
+
+
+def build_index():
+    index = InvertedIndex()
+    tags = defaultdict(list)
+    for model, column in ((Taste, Taste.taste), (Holiday, Holiday.holiday)):
+        for item_id, value in db.session.query(model.item, column):
+            tags[item_id].append(value)
+
+    rows = db.session.query(
+        Item.id, Item.title, Item.brand, Item.category, Item.img, Category.type
+        ).outerjoin(Category, Item.category == Category.id)
+    for item_id, title, brand, category, img, category_type in rows:
+        index.add(item_payload(item_id, title, brand, category, img), [
+            (title, TITLE_WEIGHT),
+            (brand, TITLE_WEIGHT),
+            (category_type, CATEGORY_WEIGHT),
+            (' '.join(tags[item_id]), TAG_WEIGHT),
+        ])
+    return index
+
+
+_memory_index = {'stamp': None, 'index': None}
+_memory_lock = threading.Lock()
+
+
+def clear_index():
+    # the next memory search rebuilds the index from the tables
+    with _memory_lock:
+        _memory_index['stamp'] = None
+        _memory_index['index'] = None
+
+
+def memory_search(term, offset, limit):
+    stamp = versions.stamps([versions.search_key()])[versions.search_key()]
+    with _memory_lock:
+        if _memory_index['index'] is None or _memory_index['stamp'] != stamp:
+            _memory_index['index'] = build_index()
+            _memory_index['stamp'] = stamp
+        index = _memory_index['index']
+    return [item for item, score in index.search(term, offset, limit)]
+
+
+POSTGRES_SEARCH = text('''
+    SELECT id, title, brand, category, img
+    FROM items, websearch_to_tsquery('english', :term) AS query
+    WHERE search_vector @@ query OR :term <% search_text
+    ORDER BY ts_rank_cd(search_vector, query) + word_similarity(:term, search_text) DESC, id
+    LIMIT :limit OFFSET :offset
+''')
+
+
+_search_columns = {}
+
+
+def has_search_columns():
+    '''
+    whether the items table has the columns of migration 5d0f3b8e6c21,
+    checked once per database
+    '''
+    url = str(db.engine.url)
+    if url not in _search_columns:
+        columns = {column['name'] for column in
+                   inspect(db.session.connection()).get_columns(Item.__tablename__)}
+        _search_columns[url] = SEARCH_COLUMNS <= columns
+        if not _search_columns[url]:
+            logger.warning('items has no search columns, run `python manage.py db upgrade`;'
+                           ' searching in memory meanwhile')
+    return _search_columns[url]
+
+
+def postgres_search(term, offset, limit):
+    rows = db.session.execute(POSTGRES_SEARCH, {
+        'term': term.lower(), 'limit': limit, 'offset': offset})
+    return [item_payload(*row) for row in rows]
+
+
+def search_backend():
+    '''
+    return: 'postgres' or 'memory', whichever search_items() runs
+    '''
+    backend = current_app.config.get('SEARCH_BACKEND', 'auto')
+    if backend == 'auto':
+        backend = 'postgres' if db.engine.dialect.name == 'postgresql' else 'memory'
+    if backend == 'postgres' and not has_search_columns():
+        backend = 'memory'
+    return backend
+
+
+def search_keys():
+    '''
+    return: the version keys a write to the indexed fields has to bump
+    '''
+    return [versions.search_key()] if search_backend() == 'memory' else []
+
+
+def _indexed_fields_changed(session):
+    for obj in list(session.new) + list(session.deleted):
+        if type(obj) in INDEXED_FIELDS:
+            return True
+    for obj in session.dirty:
+        fields = INDEXED_FIELDS.get(type(obj), ())
+        state = inspect(obj)
+        if any(state.attrs[field].history.has_changes() for field in fields):
+            return True
+    return False
+
+
+def _after_flush(session, flush_context):
+    if _indexed_fields_changed(session):
+        keys = search_keys()
+        if keys:
+            versions.bump(session.connection(), keys)
+
+
+def search_items(term, page=1, per_page=10):
+    '''
+    return: (items, has_more) for one page of results, best match first
+    '''
+    run = postgres_search if search_backend() == 'postgres' else memory_search
+    # one extra row tells us whether there is a next page
+    items = run(term, (page - 1) * per_page, per_page + 1)
+    return items[:per_page], len(items) > per_page
+
+
+def init_app(app):
+    if not event.contains(db.session, 'after_flush', _after_flush):
+        event.listen(db.session, 'after_flush', _after_flush)
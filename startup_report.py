@@ -0,0 +1,147 @@
+'''
+Cold start report: how long a fresh worker takes to import app.py,
+build the app with create_app() and answer its first request.
+
+Every run is a new interpreter, as a gunicorn worker (or a test process)
+is. For each phase the report gives the median over --runs, plus the SQL
+statements create_app() sends (the create_all() introspection shows up
+here with DB_CREATE_ALL=true) and the modules taking the longest to
+import (python -X importtime, cumulative).
+
+The environment is passed through unchanged, so compare two settings by
+running it twice:
+
+usage: python startup_report.py [--runs 5] [--top 15] [--output FILE]
+       DB_CREATE_ALL=true python startup_report.py
+'''
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+CHILD_FLAG = '--child'
+FIRST_REQUEST = '/'
+
+
+def child():
+    # runs in the fresh interpreter; prints its timings as one JSON line
+    import time
+
+    started = time.perf_counter()
+    import app as app_module
+    imported = time.perf_counter()
+
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    statements = []
+    event.listen(Engine, 'before_cursor_execute',
+                 lambda *args: statements.append(args[2]))
+
+    app = app_module.create_app()
+    booted = time.perf_counter()
+
+    response = app.test_client().get(FIRST_REQUEST)
+    answered = time.perf_counter()
+
+    print(json.dumps({
+        'import_ms': (imported - started) * 1000,
+        'create_app_ms': (booted - imported) * 1000,
+        'first_request_ms': (answered - booted) * 1000,
+        'first_request_status': response.status_code,
+        'boot_queries': len(statements),
+        'modules': len(sys.modules),
+        'authlib_imported': any(name.startswith('authlib') for name in sys.modules),
+        'auth0_imported': any(name.startswith('auth0') for name in sys.modules),
+    }))
+
+
+def run_child(extra_flags=()):
+    return subprocess.run(
+        [sys.executable, *extra_flags, os.path.abspath(__file__), CHILD_FLAG],
+        capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(top):
+    '''
+    return: [(module, cumulative ms)] of the slowest top level imports
+    '''
+    stderr = run_child(['-X', 'importtime']).stderr
+    modules, pending = {}, {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        # a module is listed after everything it imports, one level deeper
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            pending[name.strip()] = int(cumulative) / 1000
+        elif depth == 0:
+            if name.strip() == 'app':
+                modules = pending
+            pending = {}
+    return sorted(modules.items(), key=lambda pair: -pair[1])[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters to time')
+    parser.add_argument('--top', type=int, default=15, help='slowest imports to list')
+    parser.add_argument('--output', help='write the report as JSON')
+    args = parser.parse_args()
+
+    runs = [json.loads(run_child().stdout.strip().splitlines()[-1])
+            for _ in range(args.runs)]
+    phases = ['import_ms', 'create_app_ms', 'first_request_ms']
+    results = {
+        'meta': {
+            'runs': args.runs,
+            'python': platform.python_version(),
+            'started': datetime.now(timezone.utc).isoformat(),
+            'DB_CREATE_ALL': os.getenv('DB_CREATE_ALL', 'False'),
+            'database': os.getenv('DATABASE_URL', 'postgresql (config.py default)').split('://')[0],
+        },
+        'median_ms': {phase: round(statistics.median(run[phase] for run in runs), 1)
+                      for phase in phases},
+        'max_ms': {phase: round(max(run[phase] for run in runs), 1) for phase in phases},
+        'boot_queries': runs[-1]['boot_queries'],
+        'modules': runs[-1]['modules'],
+        'first_request_status': runs[-1]['first_request_status'],
+        'authlib_imported': runs[-1]['authlib_imported'],
+        'auth0_imported': runs[-1]['auth0_imported'],
+        'slowest_imports_ms': import_times(args.top),
+    }
+    results['median_ms']['total'] = round(sum(results['median_ms'][phase] for phase in phases), 1)
+
+    print('cold start over {} runs (DB_CREATE_ALL={})'.format(
+        args.runs, results['meta']['DB_CREATE_ALL']))
+    print('{:<16} {:>9} {:>9}'.format('phase', 'median', 'max'))
+    for phase in phases:
+        print('{:<16} {:>9.1f} {:>9.1f}'.format(
+            phase[:-3], results['median_ms'][phase], results['max_ms'][phase]))
+    print('{:<16} {:>9.1f}'.format('total', results['median_ms']['total']))
+    print('SQL statements in create_app: {}, modules loaded: {}, '
+          'authlib loaded: {}, auth0 loaded: {}'.format(
+              results['boot_queries'], results['modules'],
+              results['authlib_imported'], results['auth0_imported']))
+    print('slowest imports of app.py (cumulative ms):')
+    for name, milliseconds in results['slowest_imports_ms']:
+        print('  {:<32} {:>8.1f}'.format(name, milliseconds))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+        print('results written to', args.output)
+
+
+if __name__ == '__main__':
+    if CHILD_FLAG in sys.argv:
+        child()
+    else:
+        main()
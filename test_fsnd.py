@@ -1,34 +1,123 @@
 import os
+import threading
+import time
 import unittest
 import json
+from datetime import date
+from decimal import Decimal
+from flask import Flask, jsonify, request, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from werkzeug.exceptions import HTTPException
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwk
 
 from app import create_app
-from models import Category, Item, Temp_comment, Comment
+from models import Category, Item, Taste, Temp_comment, Comment, ItemRating
 from config import *
+from auth import AuthError, JWKSKeyStore, TokenCache
+from counters import row_count
+from pagination import paginate_items, encode_cursor, decode_cursor
+from cache import Cache, SharedBackend, MemoryClient
+import catalog
+from search import InvertedIndex
+import search
+import cache
+import bulk
+import counters
+import ratings
+import export
+import jobs
+import user
+import instrumentation
+import transaction
+import versions
+import fastjson
+import metrics
+import benchmark
+import datagen
+from sqlalchemy import create_engine, event, exc
+
+
+def make_jwks(kid):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption())
+    public_jwk = jwk.construct(pem, 'RS256').public_key().to_dict()
+    public_jwk.update({'kid': kid, 'use': 'sig'})
+    return pem, {'keys': [public_jwk]}
+
+
+def database_url_for_tests():
+    # conftest.py points DB_NAME (or TEST_DATABASE_URL) at a copy per
+    # pytest-xdist worker
+    return os.getenv('TEST_DATABASE_URL') or 'postgresql://{}/{}'.format(
+        os.getenv('DB_HOST', 'localhost:5432'), os.getenv('DB_NAME', 'fsnd_test'))
+
+
+_test_app = {}
 
-class FSNDTestCase(unittest.TestCase):
-    """This class represents the fsnd test case"""
+
+def get_test_app():
+    """One app per process, tables created once"""
+    if 'app' not in _test_app:
+        # fsnd.psql has the catalog only, create_all() adds the other tables
+        _test_app['app'] = create_app({'SQLALCHEMY_DATABASE_URI': database_url_for_tests(),
+                                       'DB_CREATE_ALL': True})
+    return _test_app['app']
+
+
+class TransactionTestCase(unittest.TestCase):
+    """
+    Runs each test inside a transaction that is rolled back afterwards.
+
+    The session is bound to one connection with an open transaction and a
+    SAVEPOINT. Commits in the app and the tests end the SAVEPOINT and a
+    new one is started, so nothing reaches the database and every test
+    sees the data as loaded, whatever the tests before it changed.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = get_test_app()
+        cls.client = cls.app.test_client
 
     def setUp(self):
-        """Define test variables and initialize app."""
-        self.app = create_app()
-        self.client = self.app.test_client
-        db_host = os.getenv('DB_HOST', 'localhost:5432')  
-        database_name = os.getenv('DB_NAME', 'fsnd_test')  
-        database_path = 'postgresql://{}/{}'.format(db_host, database_name)
-        setup_db(self.app, database_path)
-
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
-    
+        self.config = dict(self.app.config)
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.savepoint = self.connection.begin_nested()
+
+        db.session.remove()
+        db.session.configure(bind=self.connection, binds={})
+        event.listen(db.session, 'after_transaction_end', self.restart_savepoint)
+        cache.catalog_cache.clear()
+        search.clear_index()
+
+    def restart_savepoint(self, session, transaction):
+        if not self.savepoint.is_active:
+            self.savepoint = self.connection.begin_nested()
+
     def tearDown(self):
-        """Executed after reach test"""
-        pass
+        event.remove(db.session, 'after_transaction_end', self.restart_savepoint)
+        db.session.remove()
+        for option in ('bind', 'binds'):
+            db.session.session_factory.kw.pop(option, None)
+
+        self.transaction.rollback()
+        self.connection.close()
+        self.app.config.clear()
+        self.app.config.update(self.config)
+        # cached responses and the search index may hold rolled back rows
+        cache.catalog_cache.clear()
+        search.clear_index()
+
+
+class FSNDTestCase(TransactionTestCase):
+    """This class represents the fsnd test case"""
 
     def test_get_categories(self):
         res = self.client().get("/categories")
@@ -76,6 +165,233 @@ class FSNDTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data["success"], False)
     
+    def test_get_all_items_grouped_by_category(self):
+        res = self.client().get("/api/v1/items")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(len(data["data"]), len(Category.query.all()))
+        self.assertEqual(
+            sum(len(group["snacks"]) for group in data["data"]),
+            len(Item.query.filter(Item.category.in_(
+                [category.id for category in Category.query.all()])).all()))
+        self.assertEqual(data["total_items"], len(Item.query.all()))
+
+    def test_cursor_pagination_walks_every_item(self):
+        seen = []
+        cursor = ''
+        while cursor is not None:
+            with self.app.test_request_context(
+                    '/?per_page=3&cursor=' + cursor):
+                items, cursor = paginate_items(request)
+            seen += [item['id'] for item in items]
+
+        self.assertEqual(seen, sorted(item.id for item in Item.query.all()))
+
+    def test_get_snack_detail(self):
+        res = self.client().get("/api/v1/snack/1")
+        data = json.loads(res.data)
+        item = Item.query.get(1)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["data"]["title"], item.title)
+        self.assertEqual(data["data"]["category"], item.category_record.type)
+        self.assertEqual(data["data"]["taste"],
+                         ', '.join(taste.taste for taste in item.tastes))
+
+    def test_pages_and_api_share_catalog_service(self):
+        res = self.client().get("/api/v1/categories/1")
+        data = json.loads(res.data)
+        with self.app.app_context():
+            category = catalog.get_category(1)
+
+        self.assertEqual(data["items"], category["items"])
+        self.assertEqual(self.client().get("/categories/1").status_code, 200)
+        self.assertEqual(self.client().get("/snack/1").status_code, 200)
+
+    def test_conditional_get_snack(self):
+        res = self.client().get("/api/v1/snack/1")
+        etag = res.headers["ETag"]
+
+        res = self.client().get("/api/v1/snack/1", headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 304)
+
+        with self.app.app_context():
+            item = Item.query.get(1)
+            item.brand = item.brand + " "
+            item.update()
+            transaction.commit()
+
+        res = self.client().get("/api/v1/snack/1", headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers["ETag"], etag)
+
+    def test_cached_snack_follows_writes_of_other_workers(self):
+        self.client().get("/api/v1/snack/1")
+
+        # written without invalidating this process's cache, as another
+        # gunicorn worker would
+        with self.app.app_context():
+            item = Item.query.get(1)
+            item.brand = "Other Worker Farms"
+            item.update()
+            transaction.commit()
+
+        res = self.client().get("/api/v1/snack/1")
+        self.assertEqual(json.loads(res.data)["data"]["brand"], "Other Worker Farms")
+        res = self.client().get("/api/v1/snack/1", headers={"If-None-Match": res.headers["ETag"]})
+        self.assertEqual(res.status_code, 304)
+
+    def test_snack_polled_before_bulk_import(self):
+        next_id = max(item.id for item in Item.query.all()) + 1
+        res = self.client().get("/api/v1/snack/{}".format(next_id))
+        self.assertEqual(res.status_code, 404)
+        self.assertNotIn("ETag", res.headers)
+
+        with self.app.app_context():
+            stale = versions.make_etag("api_an_item", catalog.item_versions(next_id))
+            ids = bulk.import_items([{'title': 'New', 'brand': 'Bulk', 'category': 1,
+                                      'img': None, 'tastes': [], 'holidays': []}])
+            transaction.commit()
+        self.assertEqual(ids, [next_id])
+
+        res = self.client().get("/api/v1/snack/{}".format(next_id),
+                                headers={"If-None-Match": stale})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)["data"]["title"], "New")
+
+    def test_rating_follows_comments(self):
+        with self.app.app_context():
+            ratings.rebuild()
+            before = ItemRating.query.get(1)
+            count = before.count if before else 0
+
+            comment = Comment(comment='crunchy', rating=4, item=1, userid=1)
+            comment.insert()
+            self.assertEqual(ItemRating.query.get(1).count, count + 1)
+
+            comment.delete()
+            self.assertEqual(ItemRating.query.get(1).count, count)
+
+        res = self.client().get("/api/v1/snack/1")
+        data = json.loads(res.data)
+        self.assertEqual(data["data"]["reviews"], count)
+
+    def test_savepoint_undoes_only_its_block(self):
+        fired = []
+        with self.app.app_context():
+            Comment(comment='kept', rating=5, item=1, userid=1).insert()
+            try:
+                with transaction.savepoint():
+                    Comment(comment='undone', rating=1, item=1, userid=1).insert()
+                    transaction.on_commit(fired.append, 'undone')
+                    raise ValueError()
+            except ValueError:
+                pass
+            transaction.on_commit(fired.append, 'kept')
+            transaction.commit()
+
+            saved = Comment.query.filter(Comment.comment.in_(['kept', 'undone'])).all()
+            self.assertEqual([comment.comment for comment in saved], ['kept'])
+        self.assertEqual(fired, ['kept'])
+
+    def test_failed_commit_answers_json_error(self):
+        fired = []
+
+        def fail(session):
+            raise exc.OperationalError('COMMIT', {}, Exception('connection lost'))
+
+        event.listen(db.session, 'before_commit', fail)
+        try:
+            with self.app.test_request_context('/user/comments', method='POST'):
+                Comment(comment='lost', rating=5, item=1, userid=1).insert()
+                transaction.on_commit(fired.append, 'lost')
+                response = transaction._finish_request(jsonify({"success": True}))
+        finally:
+            event.remove(db.session, 'before_commit', fail)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(json.loads(response.data)["success"], False)
+        self.assertEqual(fired, [])
+        self.assertIsNone(Comment.query.filter(Comment.comment == 'lost').first())
+
+    def test_moderate_comments_beyond_the_in_list_limit(self):
+        pending = [comment.id for comment in Temp_comment.query.all()]
+        unknown = list(range(100000, 101500))
+
+        result = bulk.moderate_comments(pending[:1], sorted(pending[1:] + unknown))
+
+        self.assertEqual(result["approved"], 1)
+        self.assertEqual(result["rejected"], len(pending) - 1)
+        self.assertEqual(result["missing"], unknown)
+        self.assertEqual(Temp_comment.query.count(), 0)
+
+    def test_export_items_streams_every_item(self):
+        res = self.client().get("/api/v1/export/items")
+        lines = res.get_data(as_text=True).splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, "application/x-ndjson")
+        self.assertEqual([json.loads(line)["id"] for line in lines],
+                         sorted(item.id for item in Item.query.all()))
+
+    def test_search_items(self):
+        res = self.client().post("/item/search", json={"search_term": "chocolate"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertTrue(data["items"])
+
+    def test_search_falls_back_without_search_columns(self):
+        self.app.config["SEARCH_BACKEND"] = "postgres"
+        res = self.client().post("/item/search", json={"search_term": "chocolate"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["items"])
+
+    def test_auth_error_keeps_its_status(self):
+        def fail():
+            raise OSError('auth0 is down')
+
+        store = JWKSKeyStore('https://example.invalid/jwks.json')
+        store.fetch = fail
+        with self.app.test_request_context():
+            try:
+                store.get_key('key-1')
+            except AuthError as ex:
+                response = self.app.make_response(self.app.handle_user_exception(ex))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(json.loads(response.data)["error"], 503)
+
+    def test_search_stamp_follows_indexed_fields(self):
+        key = versions.search_key()
+        with self.app.app_context():
+            before = versions.stamps([key])[key]
+            Comment(comment='crunchy', rating=4, item=1, userid=1).insert()
+            self.assertEqual(versions.stamps([key])[key], before)
+
+            Taste(taste='smoky', item=1).insert()
+            self.assertEqual(versions.stamps([key])[key], before + 1)
+
+            # a Postgres search with its columns does not read the stamp
+            self.app.config["SEARCH_BACKEND"] = "postgres"
+            url = str(db.engine.url)
+            self.addCleanup(search._search_columns.pop, url, None)
+            search._search_columns[url] = True
+            Taste(taste='sweet', item=1).insert()
+            self.assertEqual(versions.stamps([key])[key], before + 1)
+
+    def test_search_items_without_term(self):
+        res = self.client().post("/item/search", json={})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data["success"], False)
+
     def test_create_item(self):
         new_item = {
             'title': 'Crunchy Cheese Flavored Snack Chips',
@@ -207,6 +523,23 @@ class FSNDTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data["success"], False)
 
+    def test_counter_table_matches_count(self):
+        self.app.config['USE_COUNTER_TABLE'] = True
+        new_comment = {
+            'item': 1,
+            'comment': 'Counted',
+            'rating': 3,
+            'userid': 2
+        }
+        with self.app.app_context():
+            counters.rebuild()
+            comment = Comment(**new_comment)
+            comment.insert()
+
+            self.assertEqual(row_count(Comment), counters.count_rows(Comment))
+            self.assertEqual(row_count(Comment, item=1),
+                             counters.count_rows(Comment, item=1))
+
     def test_delete_temp_comment(self):
         total_comments = len(Temp_comment.query.all())
         res = self.client().delete("/temp/comments/1")
@@ -241,5 +574,544 @@ class FSNDTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data["success"], False)
 
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    """JWKS caching, no network or database needed"""
+
+    def setUp(self):
+        self.fetches = 0
+        self.jwks = make_jwks('key-1')[1]
+
+        def fetch():
+            self.fetches += 1
+            return self.jwks
+
+        self.store = JWKSKeyStore('https://example.invalid/jwks.json', ttl=600)
+        self.store.fetch = fetch
+
+    def test_keys_are_fetched_once(self):
+        first = self.store.get_key('key-1')
+        second = self.store.get_key('key-1')
+
+        self.assertIsNotNone(first)
+        self.assertIs(first, second)
+        self.assertEqual(self.fetches, 1)
+
+    def test_unknown_kid_forces_rate_limited_refresh(self):
+        self.store.get_key('key-1')
+        self.jwks = make_jwks('key-2')[1]
+        self.store.min_refresh_interval = 0
+
+        self.assertIsNotNone(self.store.get_key('key-2'))
+        self.assertEqual(self.fetches, 2)
+
+        self.store.min_refresh_interval = 600
+        self.assertIsNone(self.store.get_key('key-3'))
+        self.assertEqual(self.fetches, 2)
+
+    def test_stale_keys_survive_fetch_failure(self):
+        self.store.get_key('key-1')
+
+        def fail():
+            raise OSError('auth0 is down')
+
+        self.store.fetch = fail
+        self.store._expires_at = 0
+
+        self.assertIsNotNone(self.store.get_key('key-1'))
+
+
+class CursorTestCase(unittest.TestCase):
+    """opaque keyset cursors"""
+
+    def test_round_trip(self):
+        cursor = encode_cursor([3, 42])
+        self.assertEqual(decode_cursor(cursor, 2), [3, 42])
+
+    def test_rejects_tampered_cursor(self):
+        with self.assertRaises(HTTPException):
+            decode_cursor('not-a-cursor', 1)
+        with self.assertRaises(HTTPException):
+            decode_cursor(encode_cursor(['1']), 1)
+
+
+class CatalogCacheTestCase(unittest.TestCase):
+    """read-through cache, run against the shared backend stand-in"""
+
+    def setUp(self):
+        self.cache = Cache(SharedBackend(MemoryClient()))
+
+    def test_read_through_and_invalidate(self):
+        loads = []
+
+        def loader():
+            loads.append(1)
+            return {'title': 'Chips', 'n': len(loads)}
+
+        self.assertEqual(self.cache.get_or_load('item:1', loader)['n'], 1)
+        self.assertEqual(self.cache.get_or_load('item:1', loader)['n'], 1)
+        self.cache.delete('item:1')
+        self.assertEqual(self.cache.get_or_load('item:1', loader)['n'], 2)
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 2})
+
+    def test_concurrent_misses_load_once(self):
+        loads = []
+        release = threading.Event()
+
+        def loader():
+            loads.append(1)
+            release.wait(5)
+            return 'value'
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(self.cache.get_or_load('hot', loader)))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(results, ['value'] * 8)
+
+    def test_invalidation_during_load_is_not_overwritten(self):
+        def loader():
+            self.cache.delete('item:1')
+            return 'stale'
+
+        self.assertEqual(self.cache.get_or_load('item:1', loader), 'stale')
+        self.assertEqual(self.cache.get_or_load('item:1', lambda: 'fresh'), 'fresh')
+
+    def test_entry_of_another_version_is_reloaded(self):
+        self.assertEqual(self.cache.get_or_load('item:1', lambda: 'old', 'item:1=1'), 'old')
+        self.assertEqual(self.cache.get_or_load('item:1', lambda: 'new', 'item:1=2'), 'new')
+        self.assertEqual(self.cache.get_or_load('item:1', lambda: 'other', 'item:1=2'), 'new')
+
+    def test_misses_are_not_kept(self):
+        self.assertIsNone(self.cache.get_or_load('item:9', lambda: None, 'item:9=0'))
+        self.assertEqual(self.cache.get_or_load('item:9', lambda: 'imported', 'item:9=0'),
+                         'imported')
+
+
+class InvertedIndexTestCase(unittest.TestCase):
+    """in-memory search fallback"""
+
+    def setUp(self):
+        self.index = InvertedIndex()
+        for item_id, title, category in [
+                (1, 'Milk Chocolate Covered Pretzels', 'Pretzels'),
+                (2, 'Peanut Butter Pretzel', 'Pretzels'),
+                (3, 'Chocolate Sandwich Cookies', 'Cookies')]:
+            self.index.add({'id': item_id}, [(title, 3.0), (category, 2.0)])
+
+    def test_ranks_items_matching_more_words_first(self):
+        hits = self.index.search('chocolate pretzel')
+        self.assertEqual([item['id'] for item, score in hits], [1, 2, 3])
+
+    def test_tolerates_typos(self):
+        hits = self.index.search('choclate')
+        self.assertEqual(sorted(item['id'] for item, score in hits), [1, 3])
+
+    def test_pages_results(self):
+        hits = self.index.search('pretzel', offset=1, limit=1)
+        self.assertEqual(len(hits), 1)
+
+
+class BulkValidationTestCase(unittest.TestCase):
+    """bulk import rejects the whole batch before writing"""
+
+    def test_reports_every_bad_record(self):
+        records = [
+            {'title': 'Chips', 'brand': 'Lays', 'category': 1},
+            {'title': 'Chips', 'category': '1'},
+            {'title': 'Chips', 'brand': 'Lays', 'category': 1, 'tastes': 'Salty'},
+            'not an item',
+        ]
+        with self.assertRaises(bulk.BulkError) as raised:
+            bulk.validate_items(records, max_items=10)
+
+        self.assertEqual([error['index'] for error in raised.exception.errors], [1, 2, 3])
+
+    def test_enforces_batch_size(self):
+        with self.assertRaises(bulk.BulkError):
+            bulk.validate_items([{}] * 3, max_items=2)
+
+    def test_moderation_ids(self):
+        approve, reject = bulk.validate_moderation(
+            {'approve': [3, 1, 3], 'reject': [2]}, max_ids=10)
+        self.assertEqual((approve, reject), ([1, 3], [2]))
+
+        for body in ({}, {'approve': ['1']}, {'approve': [1], 'reject': [1]}, [1]):
+            with self.assertRaises(bulk.BulkError):
+                bulk.validate_moderation(body, max_ids=10)
+
+
+class RatingDeltasTestCase(unittest.TestCase):
+    """rating aggregate bookkeeping"""
+
+    def test_stars_round_and_clamp(self):
+        self.assertEqual([ratings.stars(r) for r in (0, 1.4, 2.5, 4.49, 7)], [1, 1, 3, 4, 5])
+        self.assertIsNone(ratings.stars(None))
+
+    def test_deltas_cancel_out(self):
+        deltas = ratings.Deltas()
+        deltas.add(1, 4.0, 1)
+        deltas.add(1, 2.0, 1)
+        deltas.add(1, 4.0, -1)
+        deltas.add(2, None, 1)
+
+        self.assertEqual(list(deltas.items), [1])
+        self.assertEqual(deltas.items[1]['count'], 1)
+        self.assertEqual(deltas.items[1]['total'], 2.0)
+        self.assertEqual(ratings.summary(2, 7.0), {'rating': 3.5, 'reviews': 2})
+        self.assertEqual(ratings.summary(None, None), {'rating': None, 'reviews': 0})
+
+    def test_new_table_is_filled_from_comments(self):
+        engine = create_engine('sqlite://')
+        with engine.begin() as connection:
+            Comment.__table__.create(connection)
+            connection.execute(Comment.__table__.insert(), [
+                {'comment': 'a', 'rating': 5, 'item': 1, 'userid': 1},
+                {'comment': 'b', 'rating': 2, 'item': 1, 'userid': 2},
+                {'comment': 'c', 'rating': 4, 'item': 2, 'userid': 1}])
+            ItemRating.__table__.create(connection)
+
+            rows = connection.execute(ItemRating.__table__.select().order_by('item')).all()
+        self.assertEqual([(row.item, row.count, row.total, row.stars_5) for row in rows],
+                         [(1, 2, 7.0, 1), (2, 1, 4.0, 0)])
+        engine.dispose()
+
+
+class FastJSONTestCase(unittest.TestCase):
+    """jsonify through the JSON_BACKEND encoders"""
+
+    value = {'b': [1, 2.5, None], 'a': {2: 'two'}, 'when': date(2026, 10, 18),
+             'price': Decimal('1.5')}
+
+    def test_backends_agree(self):
+        encoded = {backend: fastjson.dumps(self.value, backend=backend)
+                   for backend in ('stdlib', 'orjson')}
+        self.assertEqual(encoded['stdlib'], encoded['orjson'])
+        self.assertEqual(json.loads(encoded['orjson']), {
+            'a': {'2': 'two'}, 'b': [1, 2.5, None],
+            'when': 'Sun, 18 Oct 2026 00:00:00 GMT', 'price': 1.5})
+        self.assertNotIn(b' ', fastjson.dumps({'a': [1, 2]}, backend='stdlib'))
+
+    def test_jsonify_is_compact_in_debug(self):
+        app = Flask(__name__)
+        app.debug = True
+        with app.app_context():
+            response = fastjson.jsonify(success=True, items=[1, 2])
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(response.get_data(), b'{"items":[1,2],"success":true}\n')
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            fastjson.backend_name('ujson')
+
+
+class ExportFormatTestCase(unittest.TestCase):
+    """export writers emit one chunk per batch"""
+
+    batches = [[{'id': 1, 'tastes': ['Sweet', 'Salty']}], [{'id': 2, 'tastes': []}]]
+
+    def test_ndjson(self):
+        chunks = list(export.to_ndjson(iter(self.batches)))
+        self.assertEqual(chunks, ['{"id": 1, "tastes": ["Sweet", "Salty"]}\n',
+                                  '{"id": 2, "tastes": []}\n'])
+
+    def test_csv_header_first(self):
+        chunks = list(export.to_csv(iter(self.batches), ['id', 'tastes']))
+        self.assertEqual(chunks, ['id,tastes\r\n', '1,"Sweet, Salty"\r\n', '2,\r\n'])
+
+
+class JobQueueTestCase(unittest.TestCase):
+    """bounded background jobs and the local signup stand-in"""
+
+    def wait(self, queue, job_id):
+        for _ in range(100):
+            job = queue.get(job_id)
+            if job['status'] not in (jobs.QUEUED, jobs.RUNNING):
+                return job
+            time.sleep(0.02)
+        self.fail('job did not finish')
+
+    def test_rejects_when_full(self):
+        queue = jobs.JobQueue(workers=1, queue_size=1, timeout=5)
+        release = threading.Event()
+        first = queue.submit('wait', release.wait)
+        queue.submit('wait', release.wait)
+
+        with self.assertRaises(jobs.JobQueueFull):
+            queue.submit('wait', release.wait)
+
+        release.set()
+        self.assertEqual(self.wait(queue, first['id'])['status'], jobs.SUCCEEDED)
+        queue.shutdown()
+
+    def test_times_out_waiting_jobs(self):
+        queue = jobs.JobQueue(workers=1, queue_size=1, timeout=0.05)
+        queue.submit('sleep', time.sleep, 0.2)
+        waiting = queue.submit('sleep', time.sleep, 0)
+
+        self.assertEqual(self.wait(queue, waiting['id'])['status'], jobs.TIMED_OUT)
+        queue.shutdown()
+
+    def test_local_signup(self):
+        user.settings['backend'] = 'local'
+        user._database = None
+        queue = jobs.JobQueue(workers=1, queue_size=2)
+        created = queue.submit('signup', user.auth0_create_user, 'a@example.com', 'Secret123')
+        duplicate = queue.submit('signup', user.auth0_create_user, 'a@example.com', 'Secret123')
+
+        self.assertEqual(self.wait(queue, created['id'])['result']['auth0_email'], 'a@example.com')
+        self.assertEqual(self.wait(queue, duplicate['id'])['status'], jobs.FAILED)
+        queue.shutdown()
+        user.settings['backend'] = 'auth0'
+        user._database = None
+
+
+class PoolInstrumentationTestCase(unittest.TestCase):
+    """checkout timing, in-use and overflow accounting"""
+
+    def test_counts_overflow_and_timeouts(self):
+        engine = create_engine('sqlite://', poolclass=instrumentation.InstrumentedQueuePool,
+                               pool_size=1, max_overflow=1, pool_timeout=0.05)
+        instrumentation.instrument_engine(engine)
+        instrumentation.pool_stats.reset()
+
+        first, second = engine.connect(), engine.connect()
+        with self.assertRaises(Exception):
+            engine.connect()
+        stats = instrumentation.pool_stats.snapshot()
+        self.assertEqual((stats['checkouts'], stats['in_use'], stats['overflow_connects'],
+                          stats['timeouts']), (2, 2, 1, 1))
+
+        first.close()
+        second.close()
+        self.assertEqual(instrumentation.pool_stats.snapshot()['in_use'], 0)
+        engine.dispose()
+
+    def test_sqlite_keeps_default_pool(self):
+        self.assertEqual(engine_options('sqlite:////tmp/fsnd.db'), {})
+        options = engine_options('postgresql://localhost/fsnd')
+        self.assertIs(options['poolclass'], instrumentation.InstrumentedQueuePool)
+
+
+class QueryTimingTestCase(unittest.TestCase):
+    """statements counted per request and per route"""
+
+    def test_server_timing_and_route_totals(self):
+        engine = create_engine('sqlite://')
+        instrumentation.instrument_queries(engine)
+        instrumentation.query_stats.reset()
+        app = Flask(__name__)
+        app.before_request(instrumentation._start_request)
+        app.after_request(instrumentation._finish_request)
+
+        @app.route('/snacks/<int:item_id>')
+        def snack(item_id):
+            with engine.connect() as connection:
+                for _ in range(3):
+                    connection.exec_driver_sql('SELECT 1')
+            return 'ok'
+
+        res = app.test_client().get('/snacks/1')
+        self.assertIn('desc="3 queries"', res.headers.getlist('Server-Timing')[0])
+        self.assertEqual(instrumentation.query_stats.snapshot()[
+            'GET /snacks/<int:item_id>']['queries'], 3)
+
+        engine.dispose()
+
+    def test_streamed_bodies_are_counted_when_closed(self):
+        engine = create_engine('sqlite://')
+        instrumentation.instrument_queries(engine)
+        instrumentation.query_stats.reset()
+        app = Flask(__name__)
+        app.before_request(instrumentation._start_request)
+        app.after_request(instrumentation._finish_request)
+
+        @app.route('/export')
+        def export_rows():
+            def rows():
+                with engine.connect() as connection:
+                    for _ in range(2):
+                        yield str(connection.exec_driver_sql('SELECT 1').scalar())
+            return app.response_class(stream_with_context(rows()))
+
+        res = app.test_client().get('/export', buffered=True)
+        self.assertEqual(res.get_data(as_text=True), '11')
+        self.assertEqual(res.headers.getlist('Server-Timing'), [])
+        self.assertEqual(instrumentation.query_stats.snapshot()['GET /export']['queries'], 2)
+
+        engine.dispose()
+
+    def test_failed_statements_do_not_shift_timings(self):
+        engine = create_engine('sqlite://')
+        instrumentation.instrument_queries(engine)
+        app = Flask(__name__)
+        app.before_request(instrumentation._start_request)
+        app.after_request(instrumentation._finish_request)
+
+        @app.route('/')
+        def index():
+            with engine.connect() as connection:
+                with self.assertRaises(exc.OperationalError):
+                    connection.exec_driver_sql('SELECT * FROM missing')
+                connection.exec_driver_sql('SELECT 1')
+            return 'ok'
+
+        res = app.test_client().get('/')
+        self.assertIn('desc="1 queries"', res.headers.getlist('Server-Timing')[0])
+
+        engine.dispose()
+
+    def test_overlapping_statements_are_timed_apart(self):
+        engine = create_engine('sqlite://')
+        instrumentation.instrument_queries(engine)
+        started = threading.Event()
+
+        def pause(seconds):
+            started.set()
+            time.sleep(seconds)
+            return seconds
+
+        @event.listens_for(engine, 'connect')
+        def add_pause(dbapi_connection, connection_record):
+            dbapi_connection.create_function('pause', 1, pause)
+
+        app = Flask(__name__)
+        app.before_request(instrumentation._start_request)
+        app.after_request(instrumentation._finish_request)
+
+        @app.route('/pause/<int:ms>')
+        def slow(ms):
+            # sqlite:// gives every thread its own connection
+            with engine.connect() as connection:
+                connection.exec_driver_sql('SELECT pause({})'.format(ms / 1000))
+            return 'ok'
+
+        def db_ms(response):
+            timing = response.headers.getlist('Server-Timing')[0]
+            return float(timing.split('dur=')[1].split(';')[0])
+
+        responses = {}
+        slow_request = threading.Thread(target=lambda: responses.update(
+            slow=app.test_client().get('/pause/300')))
+        slow_request.start()
+        started.wait(5)
+        # runs while the 300ms statement is still going
+        fast = app.test_client().get('/pause/20')
+        slow_request.join()
+
+        self.assertGreaterEqual(db_ms(responses['slow']), 300)
+        self.assertGreaterEqual(db_ms(fast), 20)
+        self.assertLess(db_ms(fast), 300)
+
+        engine.dispose()
+
+
+class MetricsTestCase(unittest.TestCase):
+    """request metrics labelled by URL rule"""
+
+    def sample(self, name, labels):
+        value = metrics.REGISTRY.get_sample_value(name, labels)
+        return value or 0
+
+    def test_counts_requests_per_rule(self):
+        app = Flask(__name__)
+        metrics.init_app(app)
+
+        @app.route('/metrics-test/<int:item_id>')
+        def metrics_test(item_id):
+            return 'ok'
+
+        labels = {'method': 'GET', 'route': '/metrics-test/<int:item_id>', 'status': '200'}
+        before = self.sample('fsnd_http_requests_total', labels)
+        client = app.test_client()
+        client.get('/metrics-test/1')
+        client.get('/metrics-test/2')
+
+        self.assertEqual(self.sample('fsnd_http_requests_total', labels) - before, 2)
+        self.assertEqual(self.sample('fsnd_http_requests_in_flight',
+                                     {'method': 'GET', 'route': labels['route']}), 0)
+        res = client.get('/metrics')
+        self.assertIn(b'fsnd_http_request_duration_seconds_bucket', res.data)
+
+
+class DataGeneratorTestCase(unittest.TestCase):
+    """generated rows, no database"""
+
+    def rows(self, items, seed):
+        return {model.__tablename__: list(rows) for model, columns, rows
+                in datagen.Generator(items, seed=seed).tables()}
+
+    def test_same_seed_same_rows(self):
+        first = self.rows(500, seed=7)
+        self.assertEqual(first, self.rows(500, seed=7))
+        self.assertNotEqual(first['comments'], self.rows(500, seed=8)['comments'])
+
+    def test_rows_reference_generated_items(self):
+        tables = self.rows(500, seed=1)
+        self.assertEqual([row[0] for row in tables['items']], list(range(1, 501)))
+        self.assertEqual(len(tables['comments']), 2500)
+        self.assertEqual(len(tables['temp_comments']), 125)
+        # position of the item column
+        for table, column in (('tastes', 2), ('holidays', 2), ('comments', 3),
+                              ('temp_comments', 3)):
+            ids = [row[0] for row in tables[table]]
+            self.assertEqual(ids, list(range(1, len(ids) + 1)))
+            self.assertTrue(all(1 <= row[column] <= 500 for row in tables[table]))
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    """benchmark suite bookkeeping"""
+
+    def test_every_route_is_benchmarked(self):
+        endpoints = set(get_test_app().view_functions)
+        covered = {route.endpoint for route in benchmark.ROUTES} | set(benchmark.SKIPPED)
+        self.assertEqual(endpoints - covered, set())
+
+    def test_percentile_and_compare(self):
+        values = list(range(1, 101))
+        self.assertEqual([benchmark.percentile(values, p) for p in (50, 95, 99)], [50, 95, 99])
+
+        path = '/tmp/fsnd-benchmark-previous.json'
+        with open(path, 'w') as previous:
+            json.dump({'routes': {'api_an_item': {'p95_ms': 10, 'queries_per_request': 2}}},
+                      previous)
+        current = {'routes': {'api_an_item': {'p95_ms': 13, 'queries_per_request': 2}}}
+        self.assertEqual(len(benchmark.compare(current, path, 0.2)), 1)
+        self.assertEqual(benchmark.compare(current, path, 0.5), [])
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """verified token LRU"""
+
+    def test_hit_until_exp(self):
+        cache = TokenCache(maxsize=2)
+        cache.set('token', {'exp': time.time() + 60, 'permissions': []})
+        cache.set('expired', {'exp': time.time() - 1, 'permissions': []})
+
+        self.assertIsNotNone(cache.get('token'))
+        self.assertIsNone(cache.get('expired'))
+        self.assertIsNone(cache.get('unknown'))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_evicts_least_recently_used(self):
+        cache = TokenCache(maxsize=2)
+        for token in ('a', 'b'):
+            cache.set(token, {'exp': time.time() + 60})
+        cache.get('a')
+        cache.set('c', {'exp': time.time() + 60})
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['size'], 2)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
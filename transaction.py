@@ -0,0 +1,127 @@
+'''
+Request-scoped unit of work.
+
+Model insert(), update() and delete() only add to and flush the session:
+the rows are written, ids assigned and the after_flush hooks (counters,
+ratings, version stamps) run, but nothing is committed. The request
+commits once, after the view returned a response below 400, and rolls
+back when it returned an error or raised. All the writes of a request
+land together or not at all, with one COMMIT (one WAL flush). When the
+COMMIT itself fails the session is rolled back and the response becomes
+the usual JSON 422.
+
+GET, HEAD and OPTIONS requests never commit, their session is simply
+closed at the end of the app context.
+
+on_commit(fn, *args) runs fn after the commit went through, for side
+effects that must not happen for rolled back writes or before other
+requests can see them, such as dropping cached responses. savepoint()
+runs a block in a SAVEPOINT: if it raises, its writes and its on_commit
+callbacks are undone and the rest of the transaction carries on.
+
+Outside a request (manage.py, scripts, tests) nothing commits by
+itself: call commit().
+'''
+import logging
+from contextlib import contextmanager
+
+from flask import current_app, request
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.exceptions import UnprocessableEntity
+
+from config import db
+
+logger = logging.getLogger(__name__)
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+_CALLBACKS = 'on_commit'
+
+
+def _callbacks():
+    # kept on the session, so they go away with it at the end of the request
+    return db.session.info.setdefault(_CALLBACKS, [])
+
+
+def on_commit(fn, *args):
+    '''
+    call fn(*args) once the current transaction has committed
+    '''
+    _callbacks().append((fn, args))
+
+
+def commit():
+    '''
+    commit the session, then run the on_commit callbacks
+    '''
+    callbacks = db.session.info.pop(_CALLBACKS, [])
+    db.session.commit()
+    for fn, args in callbacks:
+        try:
+            fn(*args)
+        except Exception:
+            # the data is committed, a failed side effect must not turn
+            # the response into an error
+            logger.exception('on_commit callback %r failed', fn)
+
+
+def rollback():
+    db.session.info.pop(_CALLBACKS, None)
+    db.session.rollback()
+
+
+@contextmanager
+def savepoint():
+    '''
+    with savepoint(): writes that are undone on their own if the block raises
+    '''
+    callbacks = _callbacks()
+    mark = len(callbacks)
+    nested = db.session.begin_nested()
+    try:
+        yield nested
+    except Exception:
+        nested.rollback()
+        del callbacks[mark:]
+        raise
+    nested.commit()
+
+
+def _failed_commit(response):
+    # the view already built its success body; swap in the 422 the views
+    # answer failed writes with, keeping the other headers (CORS)
+    error = current_app.make_response(
+        current_app.handle_http_exception(UnprocessableEntity()))
+    response.status_code = error.status_code
+    response.headers['Content-Type'] = error.headers['Content-Type']
+    response.headers.pop('ETag', None)
+    response.set_data(error.get_data())
+    return response
+
+
+def _finish_request(response):
+    if request.method in SAFE_METHODS:
+        return response
+    if response.status_code >= 400:
+        rollback()
+        return response
+    try:
+        commit()
+    except SQLAlchemyError:
+        # constraint checked at commit, serialization failure, lost
+        # connection: nothing was written and no on_commit callback runs
+        logger.exception('commit of %s %s failed', request.method, request.path)
+        rollback()
+        return _failed_commit(response)
+    return response
+
+
+def _teardown_request(exception):
+    if exception is not None:
+        rollback()
+
+
+def init_app(app):
+    # registered after the metrics and Server-Timing hooks, which Flask
+    # runs later, so the COMMIT counts towards the request time
+    app.after_request(_finish_request)
+    app.teardown_request(_teardown_request)
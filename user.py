@@ -1,18 +1,82 @@
-from auth0.v3.authentication import Database
+import threading
+import time
+import uuid
 
 from auth import AUTH0_DOMAIN, AUTH0_CLIENT_ID
 
-database = Database(AUTH0_DOMAIN)
+SIGNUP_CONNECTION = 'Username-Password-Authentication'
+
+'''
+init_app(app)
+    picks the signup backend: auth0 (default) or local, the in-memory
+    stand-in for tests and offline runs. The Auth0 client is built on
+    the first signup, with the job timeout on its HTTP calls.
+'''
+settings = {'backend': 'auth0', 'timeout': 10.0}
+_database = None
+_database_lock = threading.Lock()
+
+
+class SignupError(Exception):
+    pass
+
+
+class LocalDatabase:
+    '''
+    stand-in for auth0.v3.authentication.Database, users live in memory
+    delay: seconds each signup takes, to mimic the network call
+    '''
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.users = {}
+        self._lock = threading.Lock()
+
+    def signup(self, client_id, email, password, connection, **kwargs):
+        time.sleep(self.delay)
+        with self._lock:
+            if email in self.users:
+                raise SignupError('The user already exists.')
+            self.users[email] = uuid.uuid4().hex[:24]
+            return {'_id': self.users[email], 'email': email, 'email_verified': False}
+
+
+def get_database():
+    global _database
+    with _database_lock:
+        if _database is None:
+            if settings['backend'] == 'local':
+                _database = LocalDatabase()
+            else:
+                from auth0.v3.authentication import Database
+                _database = Database(AUTH0_DOMAIN, timeout=settings['timeout'])
+        return _database
+
 
 def auth0_create_user(email, password):
-    resp = database.signup(client_id=AUTH0_CLIENT_ID,
-                           email=email,
-                           password=password,
-                           connection='Username-Password-Authentication')
+    # imported here, requests is only needed once someone signs up
+    from requests.exceptions import Timeout
+
+    try:
+        resp = get_database().signup(client_id=AUTH0_CLIENT_ID,
+                                     email=email,
+                                     password=password,
+                                     connection=SIGNUP_CONNECTION)
+    except Timeout:
+        # reported as timed_out by the job queue
+        raise TimeoutError('Auth0 signup timed out')
+
     if "_id" in resp:
         return {
             "auth0_user_id" : "auth0|" + resp.get("_id"),
             "auth0_email" : resp.get("email")
         }
     else:
-        raise("Failed to create user on auth0, resp: " + resp)
+        raise SignupError("Failed to create user on auth0, resp: " + str(resp))
+
+
+def init_app(app):
+    global _database
+    with _database_lock:
+        settings['backend'] = app.config.get('SIGNUP_BACKEND', 'auth0')
+        settings['timeout'] = app.config.get('JOBS_TIMEOUT', 10.0)
+        _database = None
@@ -0,0 +1,223 @@
+'''
+Version stamps and conditional GETs for the catalog read endpoints.
+
+The versions table holds an integer stamp per (name, scope): one for the
+categories table, one for the items table, one per category, one per
+item and one for the in-memory search index (bumped by search.py). An
+after_flush hook bumps the stamps a write touches, on the same
+connection, so they commit together with the data. Published comments also bump the
+listings of their item, which show its rating (see ratings.py).
+
+An endpoint wrapped in conditional() derives a strong ETag from the
+stamps it depends on and answers If-None-Match with 304 without running
+the view, so only the versions table is read.
+
+The catalog cache (catalog.py) stores each payload with version_tag() of
+the same keys and reloads it when the tag no longer matches, so a body
+cached by one worker is never served under an ETag that another worker's
+write has moved on. The stamps are read once per request.
+'''
+import hashlib
+from functools import wraps
+
+from flask import current_app, g, has_app_context, make_response, request
+from sqlalchemy import Integer, any_, bindparam, event, inspect, or_, select, text, update, insert
+from sqlalchemy.dialects import postgresql, sqlite
+
+from config import db
+from models import Version, Category, Item, Taste, Holiday, Comment
+
+TABLE_SCOPE = 0
+# change this when a response format changes to invalidate client copies
+ETAG_FORMAT = 2
+# ids per IN list, under the 999 bound parameters of older SQLite builds
+IN_LIST_SIZE = 900
+
+
+def categories_key():
+    return ('categories', TABLE_SCOPE)
+
+
+def items_key():
+    return ('items', TABLE_SCOPE)
+
+
+def category_key(category_id):
+    return ('category', category_id)
+
+
+def item_key(item_id):
+    return ('item', item_id)
+
+
+def search_key():
+    # anything the search document of an item is built from
+    return ('search', TABLE_SCOPE)
+
+
+def bump(connection, keys):
+    '''
+    increment the stamps of keys, creating missing ones
+    '''
+    table = Version.__table__
+    dialect = {'postgresql': postgresql, 'sqlite': sqlite}.get(connection.dialect.name)
+    # a fixed order keeps concurrent writers from deadlocking
+    keys = sorted(set(key for key in keys if key[1] is not None))
+    if not keys:
+        return
+    if has_app_context():
+        g.pop('version_stamps', None)
+
+    if dialect is postgresql:
+        # one statement for any number of keys; executemany would be a
+        # round trip per key on psycopg2 (bulk imports, moderation)
+        connection.execute(text('''
+            INSERT INTO {0} (name, scope, stamp)
+            SELECT name, scope, 1
+            FROM unnest(CAST(:names AS text[]), CAST(:scopes AS integer[])) AS k(name, scope)
+            ORDER BY name, scope
+            ON CONFLICT (name, scope) DO UPDATE SET stamp = {0}.stamp + 1
+        '''.format(table.name)), {'names': [name for name, _ in keys],
+                                  'scopes': [scope for _, scope in keys]})
+        return
+
+    if dialect is not None:
+        # SQLite runs the executemany in process
+        statement = dialect.insert(table).values(stamp=1)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.name, table.c.scope],
+            set_={'stamp': table.c.stamp + 1}),
+            [{'name': name, 'scope': scope} for name, scope in keys])
+        return
+
+    for name, scope in keys:
+        result = connection.execute(
+            update(table)
+            .where(table.c.name == name, table.c.scope == scope)
+            .values(stamp=table.c.stamp + 1))
+        if result.rowcount == 0:
+            connection.execute(insert(table).values(name=name, scope=scope, stamp=1))
+
+
+def _read_stamps():
+    # stamps already read by this request, so the ETag and the cache
+    # check of one GET cost a single query
+    if not has_app_context():
+        return None
+    if 'version_stamps' not in g:
+        g.version_stamps = {}
+    return g.version_stamps
+
+
+def stamps(keys):
+    '''
+    return: {key: stamp} for keys, 0 for a key never written
+    '''
+    known = _read_stamps()
+    missing = [key for key in keys if known is None or key not in known]
+    found = {}
+    if missing:
+        table = Version.__table__
+        rows = db.session.execute(
+            select(table.c.name, table.c.scope, table.c.stamp).where(or_(*[
+                (table.c.name == name) & (table.c.scope == scope)
+                for name, scope in missing]))).all()
+        found = {(name, scope): stamp for name, scope, stamp in rows}
+        found = {key: found.get(key, 0) for key in missing}
+        if known is not None:
+            known.update(found)
+    return {key: found[key] if key in found else known[key] for key in keys}
+
+
+def version_tag(keys):
+    '''
+    return: "name:scope=stamp;..." for keys, changes whenever one of them is bumped
+    '''
+    current = stamps(keys)
+    return ';'.join('{}:{}={}'.format(name, scope, current[(name, scope)])
+                    for name, scope in keys)
+
+
+def make_etag(endpoint, keys):
+    raw = '{}|{}|{}'.format(ETAG_FORMAT, endpoint, version_tag(keys))
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def _changed_keys(session):
+    keys = []
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Item):
+            keys += [items_key(), item_key(obj.id), category_key(obj.category)]
+            # an item moved to another category changes both listings
+            keys += [category_key(category_id)
+                     for category_id in inspect(obj).attrs.category.history.deleted]
+        elif isinstance(obj, Category):
+            keys += [categories_key(), category_key(obj.id)]
+        elif isinstance(obj, (Taste, Holiday)):
+            keys.append(item_key(obj.item))
+    return keys
+
+
+def rating_keys(connection, item_ids):
+    '''
+    keys of every response showing the ratings of item_ids
+    '''
+    item_ids = sorted(set(item_id for item_id in item_ids if item_id is not None))
+    if not item_ids:
+        return []
+    categories = set()
+    if connection.dialect.name == 'postgresql':
+        # a single array parameter, whatever the number of ids
+        categories.update(connection.execute(
+            select(Item.category).where(Item.id == any_(
+                bindparam('item_ids', item_ids, type_=postgresql.ARRAY(Integer))))
+            .distinct()).scalars())
+    else:
+        # chunked to stay under the bound parameter limit of SQLite
+        for start in range(0, len(item_ids), IN_LIST_SIZE):
+            categories.update(connection.execute(
+                select(Item.category).where(Item.id.in_(item_ids[start:start + IN_LIST_SIZE]))
+                .distinct()).scalars())
+    return ([items_key()] + [item_key(item_id) for item_id in item_ids]
+            + [category_key(category_id) for category_id in sorted(categories)])
+
+
+def _after_flush(session, flush_context):
+    keys = _changed_keys(session)
+    # published comments change the ratings in the listings too
+    commented = [obj.item for obj in list(session.new) + list(session.dirty)
+                 + list(session.deleted) if isinstance(obj, Comment)]
+    if commented:
+        keys += rating_keys(session.connection(), commented)
+    if keys:
+        bump(session.connection(), keys)
+
+
+def conditional(keys):
+    '''
+    keys(**view_args) -> the version keys the view's response depends on
+    '''
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not current_app.config.get('ETAGS_ENABLED', True):
+                return f(*args, **kwargs)
+
+            etag = make_etag(f.__name__, keys(**kwargs))
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+                response.set_etag(etag)
+                return response
+
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+
+        return wrapper
+    return conditional_decorator
+
+
+def init_app(app):
+    if not event.contains(db.session, 'after_flush', _after_flush):
+        event.listen(db.session, 'after_flush', _after_flush)